@@ -0,0 +1,187 @@
+from step_response import StepResponse, geometric_times
+from native import SECONDS_PER_YEAR, _parse_quantity
+from geology import as_arrays
+from metrics import CaseMetrics
+from utils import num_to_str
+import scipy.integrate
+import scipy.special
+import numpy as np
+
+
+BACKEND_VERSION = "analytical-1" # Change this when the model changes so that cached results are invalidated.
+
+
+def _ierf(x):
+    """Returns the integral of the error function from 0 to x."""
+    return x * scipy.special.erf(x) - (1 - np.exp(-x**2)) / np.sqrt(np.pi)
+
+
+def _lattice_sum(x, c=0.0, num_terms=8):
+    """Returns the sum of exp(-(x*m - c)**2) over all integers m.
+
+    The sum is evaluated directly where x >= 1 and through its Poisson dual (sqrt(pi)/x) * sum of
+    exp(-(pi*k/x)**2) * cos(2*pi*k*c/x) elsewhere, so a few terms are enough for any x."""
+    x, c = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(c, dtype=float))
+    result = np.zeros(x.shape)
+    direct = x >= 1
+    if np.any(direct):
+        # The direct terms are centered at m = c/x.
+        xd, cd = x[direct], c[direct]
+        m = np.round(cd / xd)[:, None] + np.arange(-num_terms, num_terms+1)[None, :]
+        result[direct] = np.sum(np.exp(-(xd[:, None] * m - cd[:, None])**2), axis=1)
+    if np.any(~direct):
+        xs, cs = x[~direct], c[~direct]
+        k = np.arange(1, num_terms+1)[None, :]
+        result[~direct] = np.sqrt(np.pi) / xs * (1 + 2 * np.sum(np.exp(-(np.pi * k / xs[:, None])**2) * np.cos(2 * np.pi * k * cs[:, None] / xs[:, None]), axis=1))
+    return result
+
+
+def finite_line_source(t, d, H, a, num_points=4000):
+    """Returns the finite line source response factors between boreholes of length H buried at the surface at the specified distances.
+
+    The response factors are the mean temperature drops along one borehole due to the other times 2*pi*k/q', which
+    are evaluated with the same integral as in g_function(). The result has one row per distance and one column per
+    time."""
+    t, d = np.asarray(t, dtype=float), np.atleast_1d(np.asarray(d, dtype=float))
+    s = np.geomspace(0.1 / np.sqrt(4 * a * np.max(t)), 10 / np.min(d), num_points)
+    Y = 4 * _ierf(H * s) - _ierf(2 * H * s)
+    integrand = 0.5 * Y * np.exp(-(d[:, None] * s[None, :])**2) / (H * s)
+    tail = scipy.integrate.cumulative_simpson(integrand[:, ::-1], x=-np.log(s[::-1]), initial=0, axis=1)[:, ::-1]
+    log_s = np.log(1 / np.sqrt(4 * a * t))
+    return np.array([np.interp(log_s, np.log(s), row) for row in tail])
+
+
+def g_function(t, H, r_b, a, B=None, v=0.0, num_points=4000):
+    """Returns the g-function of a borehole of length H and radius r_b buried at the surface, alone or in an infinite square field of spacing B.
+
+    The mean temperature drop along the borehole wall is q'/(2*pi*k) times the g-function. With the substitution
+    s = 1/sqrt(4*a*t) of Claesson and Javed, the finite line sources of all boreholes and their images above the
+    surface share the vertical factor, so the field is a single integral over s of the lattice sum of exp(-d**2*s**2),
+    which factorizes into two one-dimensional sums evaluated by _lattice_sum(). The moving finite line source of a
+    thermal velocity v [m/s] along the x axis multiplies each term by exp(v*x/(2*a) - v**2/(16*a**2*s**2)), which
+    turns the sum along the flow into a sum of shifted Gaussians. The integral is accumulated once on a logarithmic
+    grid, so all times cost the same as one."""
+    t = np.asarray(t, dtype=float)
+    s = np.geomspace(0.1 / np.sqrt(4 * a * np.max(t)), 10 / r_b, num_points)
+    c = v / (4 * a * s)
+    # The wall is taken on the side of the borehole across the flow.
+    F = np.exp(-(r_b * s)**2 - c**2)
+    if B is not None:
+        F += _lattice_sum(B * s, c) * _lattice_sum(B * s) - np.exp(-c**2)
+    Y = 4 * _ierf(H * s) - _ierf(2 * H * s)
+    # The integrand is integrated over log(s), hence the extra factor of s.
+    integrand = 0.5 * Y * F / (H * s)
+    tail = scipy.integrate.cumulative_simpson(integrand[::-1], x=-np.log(s[::-1]), initial=0)[::-1]
+    return np.interp(np.log(1 / np.sqrt(4 * a * t)), np.log(s), tail)
+
+
+class Model:
+    """This class is a semi-analytical model of the infinite borehole field unit cell based on finite line sources.
+
+    The layers along the borehole are replaced by a homogeneous medium with their thickness weighted properties and the
+    mean thermal velocity of the groundwater flow, whose direction is along the x axis. The step response of the field
+    is evaluated with g_function() on a geometric time grid and superposed over the monthly loads. The parameter(),
+    solve() and evaluate() methods mimic an mph model like the native models."""
+
+    def __init__(self, params, geology, num_points=4000):
+        self.params, self.geology = params, geology
+        self.E_annual = params.E_annual
+        self.solution = None
+        layers = as_arrays(geology)
+        L_borehole = params.L_borehole
+        averages = layers.averages(0, -L_borehole)
+        weights = np.maximum(np.minimum(layers.z_from, 0) - np.maximum(layers.z_to, -L_borehole), 0)
+        self.k, self.C = averages["k"], averages["C"]
+        self.a = self.k / self.C
+        self.v = np.sum(weights * layers.rho_fluid * layers.Cp_fluid * layers.velocity) / np.sum(weights) / self.C
+        z = np.linspace(-L_borehole, 0, 1001)
+        T_undisturbed = np.mean(layers.T_initial(z))
+        t = geometric_times(params.num_years * SECONDS_PER_YEAR)
+        g = np.concatenate(([0], g_function(t[1:], L_borehole, 0.5 * params.D_borehole, self.a, params.borehole_spacing, self.v, num_points)))
+        self.step_response = StepResponse(t, g / (2 * np.pi * self.k * L_borehole), T_undisturbed)
+
+    @property
+    def num_dofs(self):
+        """The number of step response values, which stands for the number of unknowns of the numerical models."""
+        return len(self.step_response.t)
+
+    def parameter(self, name, value=None):
+        """Sets or returns the value of a model parameter like mph.Model.parameter()."""
+        if name != "E_annual":
+            raise ValueError(f"Unknown parameter: {name}")
+        if value is None:
+            return f"{num_to_str(self.E_annual)}[MWh]"
+        self.E_annual = _parse_quantity(value)
+        self.solution = None
+
+    def solve(self):
+        """Superposes the step response over the monthly heat extraction rates."""
+        num_months = 12 * self.params.num_years
+        monthly_fractions = np.full(12, 1/12) if self.params.monthly_fractions is None else self.params.monthly_fractions
+        T_ave = self.step_response.T_ave_monthly(self.E_annual, monthly_fractions, self.params.num_years)
+        self.solution = {"t": np.arange(num_months+1) * SECONDS_PER_YEAR / 12, "T_ave": T_ave}
+
+    def evaluate(self, expression, unit=None):
+        """Evaluates a quantity of the solution like mph.Model.evaluate()."""
+        if self.solution is None:
+            raise RuntimeError("The model must be solved before evaluating results.")
+        if expression == "t":
+            if unit in (None, "s"):
+                return self.solution["t"]
+            elif unit == "a":
+                return self.solution["t"] / SECONDS_PER_YEAR
+            raise ValueError(f"Unsupported unit: {unit}")
+        elif expression == "T_ave":
+            if unit in (None, "K"):
+                return self.solution["T_ave"] + 273.15
+            elif unit == "degC":
+                return self.solution["T_ave"]
+            raise ValueError(f"Unsupported unit: {unit}")
+        raise ValueError(f"Unsupported expression: {expression}")
+
+
+def init_model(params, geology, metrics=None, **kwargs):
+    """Constructs a new semi-analytical model having the specified parameters for simulating heat extraction from the specified geology.
+
+    Only the layers along the borehole matter, so unlike the other backends the model takes no truncation depth."""
+    if metrics is None:
+        metrics = CaseMetrics(geology.name)
+    metrics.start("model", "Creating a new analytical model...")
+    model = Model(params, geology, **kwargs)
+    metrics.stop()
+    metrics.record(num_dofs=model.num_dofs)
+    return model
+
+
+if __name__ == "__main__":
+    from superposition import eval_response
+    from budapest import make_geologies
+    from comsol import Parameters
+    import pygfunction
+    import pandas as pd
+    import time
+    # Checks the single borehole against pygfunction and the lattice sum against a brute force sum over images.
+    H, r_b, a, B = 200.0, 0.075, 1e-6, 20.0
+    t = np.geomspace(3600, 50*SECONDS_PER_YEAR, 20)
+    borehole = pygfunction.boreholes.Borehole(H, 0, r_b, 0, 0)
+    print(f"Single borehole: max_error={num_to_str(np.max(np.abs(g_function(t, H, r_b, a) - pygfunction.heat_transfer.finite_line_source(t, a, borehole, borehole))))}")
+    g_field = pygfunction.heat_transfer.finite_line_source(t, a, borehole, borehole)
+    for m, n in [(m, n) for m in range(-40, 41) for n in range(-40, 41) if (m, n) != (0, 0)]:
+        g_field = g_field + pygfunction.heat_transfer.finite_line_source(t, a, pygfunction.boreholes.Borehole(H, 0, r_b, m*B, n*B), borehole)
+    tic = time.perf_counter()
+    g_lattice = g_function(t, H, r_b, a, B)
+    toc = time.perf_counter()
+    print(f"Infinite field: time_elapsed={1000*(toc-tic):.1f}ms, max_error={num_to_str(np.max(np.abs(g_lattice[t < 5*SECONDS_PER_YEAR] - g_field[t < 5*SECONDS_PER_YEAR])))} before 5 a (81 x 81 images)")
+    # Compares E_max of the Budapest sites with the COMSOL results.
+    monthly_fractions = [0.194717, 0.17216, 0.128944, 0.075402, 0.024336, 0, 0, 0, 0.025227, 0.076465, 0.129925, 0.172824]
+    for file_name, v_groundwater in [("results_without_groundwater_flow.xlsx", 0), ("results_with_groundwater_flow.xlsx", "predefined")]:
+        geologies = {geology.name: geology for geology in make_geologies(v_groundwater=v_groundwater)}
+        data_frame = pd.read_excel(file_name)
+        errors = []
+        tic = time.perf_counter()
+        for _, row in data_frame.iterrows():
+            params = Parameters(L_borehole=row["L_borehole"], D_borehole=0.150, borehole_spacing=row["borehole_spacing"], num_years=50, E_annual=0, monthly_fractions=monthly_fractions)
+            model = init_model(params, geologies[row["Geology"]], CaseMetrics(verbose=False))
+            errors.append(eval_response(model).E_max(0) / row["E_max"] - 1)
+        toc = time.perf_counter()
+        print(f"{file_name}: num_cases={len(errors)}, time_elapsed={toc-tic:.1f}s, mean_error={100*np.mean(errors):.2f}%, max_error={100*np.max(np.abs(errors)):.2f}%")
@@ -0,0 +1,103 @@
+import numpy as np
+import hashlib
+import json
+import os
+
+
+def describe(obj):
+    """Returns a JSON serializable description of the physical content of the specified object.
+
+    Names and tags are left out so that renaming a geology, a layer or a material does not change the description."""
+    if isinstance(obj, (list, tuple, np.ndarray)):
+        return [describe(item) for item in obj]
+    elif isinstance(obj, dict):
+        return {key: describe(value) for key, value in obj.items()}
+    elif isinstance(obj, (bool, np.bool_)):
+        return bool(obj)
+    elif isinstance(obj, (int, float, np.integer, np.floating)):
+        return float(obj)
+    elif obj is None or isinstance(obj, str):
+        return obj
+    descr = {"type": type(obj).__name__}
+    for key, value in vars(obj).items():
+        if key not in ("name", "tag"):
+            descr[key] = describe(value)
+    return descr
+
+
+def stable_hash(obj):
+    """Returns a hash of the specified object that stays the same between runs and platforms."""
+    return hashlib.sha256(json.dumps(describe(obj), sort_keys=True).encode()).hexdigest()
+
+
+def case_hash(params, geology, backend_version):
+    """Returns a hash identifying a simulation of the specified geology with the specified parameters and backend."""
+    return stable_hash({"params": params, "geology": geology, "backend_version": backend_version})
+
+
+def describe_case(params, geology):
+    """Returns the description of a simulation case as a JSON string, which can be stored along with its results."""
+    return json.dumps(describe({"params": params, "geology": geology}), sort_keys=True)
+
+
+class ResultCache:
+    """This class stores simulation results on the local disk under content-addressed keys with an LRU size limit."""
+
+    def __init__(self, directory="cache", max_bytes=1024**3):
+        self.directory, self.max_bytes = directory, max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        """Returns the path of the file storing the entry with the specified key."""
+        return os.path.join(self.directory, f"{key}.npz")
+
+    def get(self, key):
+        """Returns the entry with the specified key as a dict of arrays or None if it is not in the cache."""
+        path = self.path(key)
+        try:
+            with np.load(path) as data:
+                entry = {name: data[name] for name in data.files}
+        except (FileNotFoundError, OSError, ValueError):
+            return None
+        # Marks the entry as recently used.
+        os.utime(path)
+        return entry
+
+    def put(self, key, entry):
+        """Stores a dict of arrays under the specified key and evicts the least recently used entries if needed."""
+        path = self.path(key)
+        temp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(temp_path, **entry)
+        os.replace(temp_path, path)
+        self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits in its size limit."""
+        files = []
+        for file_name in os.listdir(self.directory):
+            if file_name.endswith(".npz") and not file_name.endswith(".tmp.npz"):
+                stat = os.stat(os.path.join(self.directory, file_name))
+                files.append((stat.st_mtime, stat.st_size, file_name))
+        total_size = sum(size for _, size, _ in files)
+        for _, size, file_name in sorted(files):
+            if total_size <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.directory, file_name))
+            total_size -= size
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+
+if __name__ == "__main__":
+    from budapest import make_geologies
+    from comsol import Parameters
+    import tempfile
+    params = Parameters(L_borehole=200, D_borehole=0.150, borehole_spacing=20, num_years=50, E_annual=0)
+    geology1, geology2 = make_geologies(v_groundwater=0)[-1], make_geologies(v_groundwater=1e-8)[-1]
+    print(case_hash(params, geology1, "native-1"))
+    print(case_hash(params, geology2, "native-1"))
+    cache = ResultCache(tempfile.mkdtemp(), max_bytes=10000)
+    for i in range(5):
+        cache.put(f"entry{i}", {"T_ave": np.zeros(600), "E_max": i})
+        print(f"entry{i}", cache.get(f"entry{i}")["E_max"], sorted(os.listdir(cache.directory)))
@@ -1,87 +1,152 @@
+from gfunctions import GFunctionService, extrapolate_gfunction, asymptotic_gfunction
+from superposition import LinearResponse, find_E_max
 import matplotlib.pyplot as plt
 import scipy.interpolate
-import scipy.optimize
 import scipy.signal
 import pygfunction
 import pandas as pd
 import numpy as np
 
-def calc(N, B):
+monthly_fraction = np.ones(12) / 12     # Heat extraction @ constant rate
+
+T_surface = 5.8                         # [degC]
+q_geothermal = 42.9e-3                  # [W/m^2]
 
-    monthly_fraction = np.ones(12) / 12     # Heat extraction @ constant rate
+k_rock = 2.3                            # [W/(m*K)]
+Cp_rock = 850                           # [J/(kg*K)]
+rho_rock = 2800                         # [kg/m^3]
 
-    T_surface = 5.8                         # [degC]
-    q_geothermal = 42.9e-3                  # [W/m^2]
+R_borehole = 0.100                      # [K/(W/m)]
 
-    k_rock = 2.3                            # [W/(m*K)]
-    Cp_rock = 850                           # [J/(kg*K)]
-    rho_rock = 2800                         # [kg/m^3]
+borehole_length = 200.0                 # [m]
+borehole_radius = 0.150 / 2             # [m]
 
-    R_borehole = 0.100                      # [K/(W/m)]
+num_years = 50                          # [1]
 
-    borehole_length = 200.0                 # [m]
-    borehole_radius = 0.150 / 2             # [m]
+T_target = -1.5                         # [degC]
 
-    num_years = 50                          # [1]
+a_rock = k_rock / (rho_rock * Cp_rock)  # [m^2/s]
 
-    T_target = -1.5                         # [degC]
+t_max = num_years * 365 * 24 * 3600     # [s]
 
-    a_rock = k_rock / (rho_rock * Cp_rock)  # [m^2/s]
+delta_t = 730 * 3600                    # [s]
 
-    t_max = num_years * 365 * 24 * 3600     # [s]
+T_initial = T_surface + q_geothermal / k_rock * (0.5 * borehole_length) # Temperature @ midpoint
 
-    delta_t = 730 * 3600                    # [s]
+t = pygfunction.utilities.time_geometric(delta_t, t_max, 50)
 
-    borehole_geometry = (N, N)
-    borehole_spacing = (B, B)
+ti = np.arange(delta_t, t_max+delta_t, delta_t)
 
-    T_initial = T_surface + q_geothermal / k_rock * (0.5 * borehole_length) # Temperature @ midpoint
+_service = None
 
-    borehole_field = pygfunction.boreholes.rectangle_field(N_1=borehole_geometry[0], N_2=borehole_geometry[1], B_1=borehole_spacing[0], B_2=borehole_spacing[1], H=borehole_length, D=0, r_b=borehole_radius)
+def gfunction_service():
+    """Returns the g-function service, which is created on first use so that importing this module creates no directories."""
 
-    total_borehole_length = borehole_geometry[0] * borehole_geometry[1] * borehole_length
+    global _service
 
-    t = pygfunction.utilities.time_geometric(delta_t, t_max, 50)
-    g = pygfunction.gfunction.uniform_temperature(borehole_field, t, a_rock, nSegments=1, disp=False)
+    if _service is None:
+        _service = GFunctionService()
 
-    ti = np.arange(delta_t, t_max+delta_t, delta_t)
-    gi = scipy.interpolate.interp1d(t, g)(ti)
+    return _service
 
-    def evaluate_mean_fluid_temperatures(annual_heat_load):
+def calc_gfunction(N, B):
+    """Returns the g-function of an N x N field with spacing B interpolated to the monthly time grid."""
 
-        monthly_heat_load = annual_heat_load * monthly_fraction
+    g = gfunction_service().get(N, B, borehole_length, borehole_radius, a_rock, t)
 
-        heat_rate = np.ravel(np.tile(monthly_heat_load*1_000_000/730.0, (1, num_years)))
+    return scipy.interpolate.interp1d(t, g)(ti)
 
-        specific_heat_rate = heat_rate / total_borehole_length
-        delta_q = np.hstack((-specific_heat_rate[0], np.diff(-specific_heat_rate)))
+def eval_unit_responses(gi, total_borehole_length):
+    """Returns the linear mean fluid temperature responses of N x N fields for g-functions on the monthly time grid given as rows of an array.
 
-        T_wall = T_initial + scipy.signal.fftconvolve(delta_q, gi/(2.0*np.pi*k_rock), mode="full")[:len(ti)]
-        T_fluid = T_wall - R_borehole * specific_heat_rate
+    The responses are evaluated for an annual heat load of 1 MWh with a single FFT convolution for all fields, and the
+    response to any other load is T_initial + annual_heat_load * T_unit."""
 
-        return T_fluid
+    total_borehole_length = np.atleast_1d(total_borehole_length)
 
-    def cost_function(annual_heat_load):
+    heat_rate = np.ravel(np.tile(monthly_fraction*1_000_000/730.0, (1, num_years)))
 
-        T_fluid = evaluate_mean_fluid_temperatures(annual_heat_load)
+    specific_heat_rate = heat_rate[None, :] / total_borehole_length[:, None]
+    delta_q = np.hstack((-specific_heat_rate[:, :1], np.diff(-specific_heat_rate, axis=1)))
 
-        return np.abs(np.min(T_fluid) - T_target)
+    T_wall = scipy.signal.fftconvolve(delta_q, np.atleast_2d(gi)/(2.0*np.pi*k_rock), mode="full", axes=1)[:, :len(ti)]
+    T_unit = T_wall - R_borehole * specific_heat_rate
 
-    annual_heat_load = scipy.optimize.fminbound(cost_function, 1, 100000, xtol=0.001)
+    return [LinearResponse(ti, np.full(len(ti), T_initial), row) for row in T_unit]
+
+def calc(N, B):
 
-    T_fluid = evaluate_mean_fluid_temperatures(annual_heat_load)
+    response = eval_unit_responses(calc_gfunction(N, B), N * N * borehole_length)[0]
+
+    annual_heat_load, T_fluid, num_evaluations = find_E_max(response.T_ave, T_target, T_undisturbed=T_initial)
+
+    print(f"N={N}, B={B}, num_evaluations={num_evaluations}")
 
     return annual_heat_load, T_fluid[-1]
 
+def eval_E_max(gi, total_borehole_length):
+    """Returns E_max and the final mean fluid temperature for g-functions on the monthly time grid given as rows of an array."""
+
+    responses = eval_unit_responses(gi, total_borehole_length)
+
+    E_max = np.array([response.E_max(T_target) for response in responses])
+
+    T_fluid = np.array([response.T_ave(E)[-1] for response, E in zip(responses, E_max)])
+
+    return E_max, T_fluid
+
+def calc_batch(N, B, max_workers=None):
+    """Solves E_max for all pairs of N and B at once by computing the missing g-functions in parallel."""
+
+    N, B = np.broadcast_arrays(np.atleast_1d(N), np.atleast_1d(B))
+
+    gi = scipy.interpolate.interp1d(t, gfunction_service().get_many(N, B, borehole_length, borehole_radius, a_rock, t, max_workers), axis=1)(ti)
+
+    return eval_E_max(gi, N * N * borehole_length)
+
+def calc_infinite(B, N=(8, 12, 16, 24, 32), tolerance=0.01, N_max=1000, max_workers=None):
+    """Extrapolates the g-function and E_max per borehole of an infinite field with spacing B from the g-functions of N x N fields.
+
+    Returns the g-function on the monthly time grid and its error estimate, E_max per borehole and its error estimate, and
+    the smallest field size from which on E_max per borehole stays within the tolerance of the infinite field."""
+
+    N = np.asarray(N)
+
+    g = gfunction_service().get_many(N, B, borehole_length, borehole_radius, a_rock, t, max_workers)
+
+    g_inf, g_error, coefficients = extrapolate_gfunction(N, g)
+
+    interpolate = lambda g: scipy.interpolate.interp1d(t, g, axis=-1)(ti)
+
+    # E_max decreases with the g-function, so the error band of the g-function gives the error band of E_max.
+    E_max, _ = eval_E_max(interpolate(np.array([g_inf, g_inf - g_error, g_inf + g_error])), borehole_length)
+    E_error = 0.5 * (E_max[1] - E_max[2])
+
+    N_candidates = np.arange(1, N_max+1)
+    E_candidates, _ = eval_E_max(interpolate(asymptotic_gfunction(coefficients, N_candidates)), N_candidates * N_candidates * borehole_length)
+    outside = np.flatnonzero(np.abs(E_candidates / N_candidates**2 / E_max[0] - 1) > tolerance)
+    N_effective = N_candidates[outside[-1]] + 1 if len(outside) > 0 else 1
+
+    print(f"B={B}, g_inf={g_inf[-1]:.4f}\xb1{g_error[-1]:.4f}, E_max={E_max[0]:.4f}\xb1{E_error:.4f} MWh per borehole, N_effective={N_effective} for tolerance={tolerance}")
+
+    return interpolate(g_inf), interpolate(g_error), E_max[0], E_error, N_effective
+
 if __name__ == "__main__":
 
-    df = pd.DataFrame(columns=["N", "E_max", "T_fluid"])
+    N = np.arange(1, 101)
+
+    E_max, T_fluid = calc_batch(N, 20)
+
+    df = pd.DataFrame({"N": N, "E_max": E_max, "T_fluid": T_fluid})
+    df.to_excel("results_concept_validation.xlsx")
 
-    for N in range(101):
+    for i in range(len(N)):
+        print(f"{N[i]} {E_max[i]:.0f} {T_fluid[i]:.6f}")
 
-        E_max, T_fluid = calc(N, 20)
+    # The infinite field limit, which the batch approaches as N grows.
+    g_inf, g_error, E_max_inf, E_error, N_effective = calc_infinite(20)
 
-        df.loc[len(df)] = [N, E_max, T_fluid]
-        df.to_excel("results_concept_validation.xlsx")
+    df = pd.DataFrame({"t": ti / (365 * 24 * 3600), "g_inf": g_inf, "g_error": g_error})
+    df.to_excel("results_concept_validation_infinite.xlsx")
 
-        print(f"{N} {E_max:.0f} {T_fluid:.6f}")
+    print(f"inf {E_max_inf:.4f}\xb1{E_error:.4f} MWh per borehole, N_effective={N_effective}")
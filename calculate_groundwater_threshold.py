@@ -2,85 +2,82 @@
 # This script is used to estimate the influence of groundwater flow on the results
 # ================================================================================
 
-from comsol import Parameters, init_model, eval_temp
+from comsol import BACKEND_VERSION, Parameters, init_model
+from superposition import eval_cached_response, find_groundwater_threshold
+from cache import ResultCache, case_hash, describe_case
+from geology import peclet_number
+from results import ResultStore
 from budapest import make_geologies
-from itertools import product
-import matplotlib.pyplot as plt
-import pandas as pd
-import numpy as np
-import os, mph
+import native, os
 
 
 os.environ["KMP_DUPLICATE_LIB_OK"] = "True" # Gets rid of the annoying OpenMP initialization error.
 
 
-if __name__ == "__main__":
+def calculate_groundwater_threshold(backend="comsol", L_borehole=200, borehole_spacing=20, departure=0.01, peclet_min=0.1, v_upper=1e-5, T_min=0.0):
+    """Finds for each Budapest site the uniform groundwater flow velocity at which E_max departs from its value without groundwater flow by the specified fraction."""
 
     file_name = "groundwater_threshold.xlsx"
 
     monthly_fractions = [0.194717, 0.17216, 0.128944, 0.075402, 0.024336, 0, 0, 0, 0.025227, 0.076465, 0.129925, 0.172824]
 
-    v_groundwater = np.logspace(-9, -5, 9)
-
-    L_borehole = 200
-    borehole_spacing = 20
-
-    client = mph.start(cores=16)
-
-    for i in range(len(v_groundwater)):
+    geologies = make_geologies(v_groundwater=0)
 
-        geologies = make_geologies(v_groundwater=v_groundwater[i])
+    params = Parameters(L_borehole=L_borehole, D_borehole=0.150, borehole_spacing=borehole_spacing, E_annual=0, num_years=50, monthly_fractions=monthly_fractions)
 
-        geology_name, L_borehole, borehole_spacing, v_groundwater = uncalculated.pop()
+    if backend == "comsol":
+        import mph
+        client = mph.start(cores=16)
+        backend_version = BACKEND_VERSION
+    elif backend == "native":
+        backend_version = native.BACKEND_VERSION
+    else:
+        raise ValueError(f"Unknown backend: {backend}")
 
-        print(f"Calculating geology={geology_name}, L_borehole={L_borehole} m, borehole_spacing={borehole_spacing} m, v_groundwater={v_groundwater} m")
+    cache = ResultCache()
 
-        params = Parameters(L_borehole=L_borehole, D_borehole=0.150, borehole_spacing=borehole_spacing, E_annual=0, num_years=50, monthly_fractions=monthly_fractions)
+    store = ResultStore()
+    store.create_table("groundwater_threshold", {"Geology": "TEXT", "L_borehole": "REAL", "borehole_spacing": "REAL", "departure": "REAL", "E_no_flow": "REAL", "v_prescreen": "REAL", "v_threshold": "REAL", "v_below": "REAL", "v_above": "REAL", "num_evaluations": "INTEGER", "backend": "TEXT"})
 
-        geology = next(filter(lambda geology: geology.name==geology_name, geologies))
-
-        for layer in geology.layers:
-            layer.velocity = v_groundwater
+    def eval_E_max(geology):
+        # The responses are cached under the same keys as in calculate_potentials(), so the baseline without groundwater
+        # flow is usually already there.
+        if backend == "comsol":
+            make_model = lambda: init_model(client, params, geology)
+        else:
+            make_model = lambda: native.init_model(params, geology)
+        try:
+            response = eval_cached_response(cache, case_hash(params, geology, backend_version), make_model, T_min, case=describe_case(params, geology), backend=backend_version)
+        finally:
+            if backend == "comsol":
+                client.clear()
+        return response.E_max(T_min)
 
-        model = init_model(client, params, geology)
+    for geology in geologies:
 
-        client.clear()
-        #client.save(f"model_{L_borehole}_{borehole_spacing}_{}
+        key = case_hash(params, geology, f"{backend_version}+threshold-{departure}")
 
-        if borehole_spacing == 100:
-            x = [50, 100, 150]
-        else:
-            x = [5, 10, 20]
-        y = [eval_temp(model, x[i]) for i in range(len(x))]
+        if ("groundwater_threshold", key) in store:
+            print(f"Skipping geology={geology.name}, L_borehole={L_borehole} m, borehole_spacing={borehole_spacing} m")
+            continue
 
-        p = np.polyfit(x, y, 1)
+        print(f"Calculating geology={geology.name}, L_borehole={L_borehole} m, borehole_spacing={borehole_spacing} m")
 
-        SS_res = np.sum((y - np.polyval(p, x))**2)
-        SS_tot = np.sum((y - np.mean(y))**2)
+        E_no_flow = eval_E_max(geology)
 
-        R_squared = 1 - SS_res / SS_tot
+        # The Peclet number over the borehole spacing is proportional to the velocity, so velocities below the one
+        # giving peclet_min in the most permeable layer are skipped without simulating them.
+        v_prescreen = peclet_min / peclet_number(geology.with_velocity(1.0), borehole_spacing, L_borehole)
 
-        RMSE = np.sqrt(np.mean((y - np.polyval(p, x))**2))
+        v_threshold, v_below, v_above, num_evaluations = find_groundwater_threshold(lambda velocity: eval_E_max(geology.with_velocity(velocity)), E_no_flow, v_prescreen, v_upper, departure)
 
-        xi = np.linspace(x[0], x[-1], 1000)
-        yi = np.polyval(p, xi)
+        print(f"geology={geology.name}, L_borehole={L_borehole} m, borehole_spacing={borehole_spacing} m, E_no_flow={E_no_flow:.6f} MWh, v_prescreen={v_prescreen:.3g} m/s, v_threshold={v_threshold:.3g} m/s, num_evaluations={num_evaluations}")
 
-        crude_estimate = -p[1] / p[0]
+        store.append("groundwater_threshold", key, {"Geology": geology.name, "L_borehole": L_borehole, "borehole_spacing": borehole_spacing, "departure": departure, "E_no_flow": E_no_flow, "v_prescreen": v_prescreen, "v_threshold": v_threshold, "v_below": v_below, "v_above": v_above, "num_evaluations": num_evaluations, "backend": backend_version})
 
-        plt.figure()
-        plt.plot(x, y, "bo")
-        plt.plot(xi, yi, "r-")
-        plt.axhline(0, ls="--", color="r")
-        plt.axvline(crude_estimate, ls="--", color="r")
-        plt.plot([crude_estimate], [0], "rx")
-        plt.gca().set_xlim([x[0], x[-1]])
-        plt.xlabel("E_annual [MWh]")
-        plt.ylabel(u"T_wall [\xb0C]")
-        plt.tight_layout()
-        plt.show()
+    store.export_excel("groundwater_threshold", file_name)
 
-        print(f"geology={geology.name}, L_borehole={params.L_borehole} m, borehole_spacing={borehole_spacing} m, v_groundwater={v_groundwater} m/s, crude_estimate={crude_estimate:.6f} MWh")
 
-        data_frame.loc[len(data_frame)] = [geology.name, L_borehole, borehole_spacing, v_groundwater, crude_estimate, R_squared, RMSE]
+if __name__ == "__main__":
 
-        data_frame.to_excel(file_name, index=False)
+    calculate_groundwater_threshold()
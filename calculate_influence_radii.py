@@ -1,8 +1,9 @@
-from comsol import Parameters, init_model, eval_temp
+from comsol import BACKEND_VERSION, Parameters, ModelCache
+from superposition import eval_response, find_influence_radius
+from results import ResultStore
+from cache import stable_hash
 from budapest import make_geologies
 from itertools import product
-import matplotlib.pyplot as plt
-import numpy as np
 import os, mph
 
 
@@ -11,80 +12,45 @@ os.environ["KMP_DUPLICATE_LIB_OK"] = "True" # Gets rid of the annoying OpenMP in
 
 if __name__ == "__main__":
 
-    file_name = "results_influence_radius.txt"
+    file_name = "results_influence_radius.xlsx"
 
     monthly_fractions = [0.194717, 0.17216, 0.128944, 0.075402, 0.024336, 0, 0, 0, 0.025227, 0.076465, 0.129925, 0.172824]
 
-    geologies = make_geologies(v_groundwater=0)
-
-    cases = list(product(*[map(lambda geology: geology.name, geologies), [100, 200]]))
-
-    #client = mph.start(cores=6)
-
-    X = [20, 30, 40, 50, 60, 70, 80, 90, 100, 110, 120, 130, 140]
+    # The influence radius is the borehole spacing at which E_max per borehole reaches this fraction of the value of
+    # an isolated borehole, which is approximated by a borehole spacing far beyond the thermal reach of 50 years.
+    fraction, B_isolated, xtol, T_min = 0.95, 500, 1.0, 0.0
 
-    file = open(file_name, "w")
-    file.write(" ".join(str(_X) for _X in X) + "\n")
-    file.close()
-
-    for i in range(12): case = cases.pop(); print(case)
-
-    print(cases)
+    geologies = make_geologies(v_groundwater=0)
 
-    while len(cases) > 0:
+    cases = list(product(geologies, [100, 200]))
 
-        geology_name, L_borehole = cases.pop()
+    client = mph.start(cores=6)
 
-        geology = next(filter(lambda geology: geology.name==geology_name, geologies))
+    # The evaluations of each case differ only in the borehole spacing, so the model of each geology and borehole
+    # length is built once and updated in place.
+    models = ModelCache(client)
 
-        Y = []
+    store = ResultStore()
+    store.create_table("influence_radii", {"Geology": "TEXT", "L_borehole": "REAL", "fraction": "REAL", "influence_radius": "REAL", "tolerance": "REAL", "E_isolated": "REAL", "num_evaluations": "INTEGER"})
 
-        file = open(file_name, "a")
-        file.write(f"geology={geology.name}, L_borehole={L_borehole} m\n")
-        file.close()
+    for geology, L_borehole in cases:
 
-        for borehole_spacing in X:
+        key = stable_hash({"geology": geology, "L_borehole": L_borehole, "fraction": fraction, "B_isolated": B_isolated, "xtol": xtol, "T_min": T_min, "backend_version": BACKEND_VERSION})
 
-            print(f"Calculating geology={geology.name}, L_borehole={L_borehole} m, borehole_spacing={borehole_spacing} m")
+        if ("influence_radii", key) in store:
+            print(f"Skipping geology={geology.name}, L_borehole={L_borehole} m")
+            continue
 
+        def eval_E_max(borehole_spacing):
             params = Parameters(L_borehole=L_borehole, D_borehole=0.150, borehole_spacing=borehole_spacing, E_annual=0, num_years=50, monthly_fractions=monthly_fractions)
+            print(f"Calculating geology={geology.name}, L_borehole={L_borehole} m, borehole_spacing={borehole_spacing:.2f} m")
+            # The response is linear in the heat extraction, so one solve gives E_max.
+            return eval_response(models.get(params, geology)).E_max(T_min)
 
-            #model = init_model(client, params, geology)
-
-            x = [10, 20, 40]
-            #y = [eval_temp(model, x[i]) for i in range(len(x))]
-            y = [1, 2, 3]
-
-            p = np.polyfit(x, y, 1)
-
-            SS_res = np.sum((y - np.polyval(p, x))**2)
-            SS_tot = np.sum((y - np.mean(y))**2)
-
-            R_squared = 1 - SS_res / SS_tot
-
-            RMSE = np.sqrt(np.mean((y - np.polyval(p, x))**2))
-
-            xi = np.linspace(x[0], x[-1], 1000)
-            yi = np.polyval(p, xi)
-
-            crude_estimate = -p[1] / p[0]
-
-            Y.append(crude_estimate)
+        influence_radius, tolerance, E_isolated, num_evaluations = find_influence_radius(eval_E_max, B_isolated, fraction, xtol=xtol)
 
-            plt.figure()
-            plt.plot(x, y, "bo")
-            plt.plot(xi, yi, "r-")
-            plt.axhline(0, ls="--", color="r")
-            plt.axvline(crude_estimate, ls="--", color="r")
-            plt.plot([crude_estimate], [0], "rx")
-            plt.gca().set_xlim([x[0], x[-1]])
-            plt.xlabel("E_annual [MWh]")
-            plt.ylabel(u"T_wall [\xb0C]")
-            plt.tight_layout()
-            plt.show()
+        store.append("influence_radii", key, {"Geology": geology.name, "L_borehole": L_borehole, "fraction": fraction, "influence_radius": influence_radius, "tolerance": tolerance, "E_isolated": E_isolated, "num_evaluations": num_evaluations})
 
-            print(f"geology={geology.name}, L_borehole={params.L_borehole} m, borehole_spacing={params.borehole_spacing} m, crude_estimate={crude_estimate:.6f} MWh")
+        print(f"geology={geology.name}, L_borehole={L_borehole} m, influence_radius={influence_radius:.2f}\xb1{tolerance:.2f} m, E_isolated={E_isolated:.6f} MWh, num_evaluations={num_evaluations}")
 
-        file = open(file_name, "a")
-        file.write(" ".join(str(_Y) for _Y in Y) + "\n")
-        file.close()
+    store.export_excel("influence_radii", file_name)
@@ -0,0 +1,85 @@
+from comsol import Parameters, init_model
+from superposition import eval_response
+from budapest import make_geologies
+from metrics import CaseMetrics
+from mesh import get_policy
+import pandas as pd
+import numpy as np
+import native, os
+
+
+os.environ["KMP_DUPLICATE_LIB_OK"] = "True" # Gets rid of the annoying OpenMP initialization error.
+
+
+def calculate_mesh_convergence(policies=("coarse", "standard", "fine"), reference=None, with_groundwater_flow=False, L_borehole=200, borehole_spacing=20, backend="native", T_min=0.0):
+    """Solves E_max for each Budapest geology with each mesh policy and returns the errors against a reference mesh together with the costs.
+
+    The reference defaults to the last policy, so it should be the finest one."""
+
+    monthly_fractions = [0.194717, 0.17216, 0.128944, 0.075402, 0.024336, 0, 0, 0, 0.025227, 0.076465, 0.129925, 0.172824]
+
+    policies = [get_policy(policy) for policy in policies]
+
+    reference = policies[-1] if reference is None else get_policy(reference)
+
+    geologies = make_geologies(v_groundwater="predefined" if with_groundwater_flow else 0)
+
+    if backend == "comsol":
+        import mph
+        client = mph.start(cores=8)
+    elif backend != "native":
+        raise ValueError(f"Unknown backend: {backend}")
+
+    params = Parameters(L_borehole=L_borehole, D_borehole=0.150, borehole_spacing=borehole_spacing, E_annual=0, num_years=50, monthly_fractions=monthly_fractions)
+
+    records = []
+
+    for geology in geologies:
+
+        for policy in policies + ([reference] if reference not in policies else []):
+
+            print(f"Calculating geology={geology.name}, mesh={policy.name}")
+
+            metrics = CaseMetrics(geology.name)
+
+            if backend == "comsol":
+                model = init_model(client, params, geology, metrics, policy)
+            else:
+                model = native.init_model(params, geology, metrics, policy)
+
+            response = eval_response(model, metrics=metrics)
+
+            if backend == "comsol":
+                client.clear()
+
+            record = metrics.to_dict()
+            record.update(geology=geology.name, thickness=geology.thickness, mesh=policy.name, E_max=response.E_max(T_min), time_total=sum(metrics.phases.values()))
+            records.append(record)
+
+    data_frame = pd.DataFrame(records)
+
+    E_reference = data_frame[data_frame["mesh"] == reference.name].set_index("geology")["E_max"]
+
+    data_frame["E_max_error"] = np.abs(data_frame["E_max"] / data_frame["geology"].map(E_reference) - 1)
+
+    return data_frame
+
+
+def cheapest_policy(data_frame, tolerance=0.01):
+    """Returns the name of the cheapest mesh policy whose E_max error stays within the specified relative tolerance for all geologies or None if none does."""
+    summary = data_frame.groupby("mesh").agg(E_max_error=("E_max_error", "max"), time_total=("time_total", "sum"))
+    summary = summary[summary["E_max_error"] <= tolerance].sort_values("time_total")
+    return summary.index[0] if len(summary) > 0 else None
+
+
+if __name__ == "__main__":
+
+    data_frame = calculate_mesh_convergence()
+
+    data_frame.to_excel("results_mesh_convergence.xlsx", index=False)
+
+    for _, row in data_frame.iterrows():
+        print(f"geology={row['geology']}, mesh={row['mesh']}, num_dofs={row['num_dofs']:,}, time_total={row['time_total']:.1f}s, E_max={row['E_max']:.3f} MWh, E_max_error={100*row['E_max_error']:.2f}%")
+
+    for tolerance in [0.005, 0.01, 0.02, 0.05]:
+        print(f"Cheapest mesh within {100*tolerance:.1f}%: {cheapest_policy(data_frame, tolerance)}")
@@ -1,17 +1,20 @@
-from comsol import Parameters, init_model, eval_temp
-from geology import Geology, PorousMaterial, PorousLayer
+from comsol import BACKEND_VERSION, Parameters, init_model, eval_temp
+from superposition import eval_cached_response
+from cache import ResultCache, case_hash, describe_case
+from mesh import mesh_version
+from results import ResultStore
+from geology import truncation_depth
 from budapest import make_geologies
-from itertools import product
 import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
-import os, mph
+import analytical, native, os
 
 
 os.environ["KMP_DUPLICATE_LIB_OK"] = "True" # Gets rid of the annoying OpenMP initialization error.
 
 
-def calculate_potentials(with_groundwater_flow, plot_fits=False):
+def calculate_potentials(with_groundwater_flow, plot_fits=False, backend="comsol", superposition=True, mesh=None, truncation=None):
 
     monthly_fractions = [0.194717, 0.17216, 0.128944, 0.075402, 0.024336, 0, 0, 0, 0.025227, 0.076465, 0.129925, 0.172824]
 
@@ -26,9 +29,46 @@ def calculate_potentials(with_groundwater_flow, plot_fits=False):
         file_name = "results_without_groundwater_flow.xlsx"
         geologies = make_geologies(v_groundwater=0)
 
-    data_frame = pd.read_excel(file_name)
+    reference_file_name = file_name
 
-    client = mph.start(cores=8)
+    # The COMSOL results are the reference the other backends are compared
+    # against, so the other backends write to their own files and start from
+    # the cases of the reference file without its results.
+    if backend != "comsol":
+        file_name = file_name.replace(".xlsx", f"_{backend}.xlsx")
+
+    if os.path.exists(file_name):
+        data_frame = pd.read_excel(file_name)
+    else:
+        data_frame = pd.read_excel(reference_file_name)
+        data_frame[["E_max", "R_squared", "RMSE"]] = np.nan
+
+    if "backend" not in data_frame:
+        data_frame["backend"] = None
+
+    if backend == "comsol":
+        import mph
+        client = mph.start(cores=8)
+        backend_version = mesh_version(BACKEND_VERSION, mesh)
+    elif backend == "native":
+        backend_version = mesh_version(native.BACKEND_VERSION, mesh)
+    elif backend == "axisymmetric":
+        if with_groundwater_flow:
+            raise ValueError("The axisymmetric backend can not simulate groundwater flow.")
+        backend_version = mesh_version(native.AXISYMMETRIC_VERSION, mesh)
+    elif backend == "analytical":
+        backend_version = analytical.BACKEND_VERSION
+    else:
+        raise ValueError(f"Unknown backend: {backend}")
+
+    cache = ResultCache()
+
+    # Finished cases are appended to the results store one at a time and the
+    # Excel file is written only once at the end, so an interrupted run loses
+    # at most the case being calculated.
+    store = ResultStore()
+    table = reference_file_name[len("results_"):-len(".xlsx")]
+    store.create_table(table, {"Geology": "TEXT", "L_borehole": "REAL", "borehole_spacing": "REAL", "E_max": "REAL", "R_squared": "REAL", "RMSE": "REAL", "backend": "TEXT"})
 
     for i in range(len(data_frame)):
 
@@ -37,8 +77,6 @@ def calculate_potentials(with_groundwater_flow, plot_fits=False):
         if not np.isnan(row["E_max"]):
             print(f"Skipping geology={row['Geology']} L_borehole={row['L_borehole']} m, borehole_spacing={row['borehole_spacing']} m, E_annual={row['E_max']} MWh")
             continue
-        else:
-            print(f"Calculating geology={row['Geology']} L_borehole={row['L_borehole']} m, borehole_spacing={row['borehole_spacing']} m")
 
         params = Parameters(L_borehole=row["L_borehole"], D_borehole=0.150, borehole_spacing=row["borehole_spacing"], E_annual=0, num_years=50, monthly_fractions=monthly_fractions)
 
@@ -48,41 +86,85 @@ def calculate_potentials(with_groundwater_flow, plot_fits=False):
 
         geology = geology[0]
 
-        model = init_model(client, params, geology)
+        # The geology is truncated before hashing, so truncated and full
+        # depth results are cached separately.
+        if truncation is not None:
+            geology = geology.truncate(truncation_depth(geology, params.L_borehole, params.num_years, truncation))
+
+        key = case_hash(params, geology, backend_version)
+
+        record = store.get(table, key)
+
+        if record is not None:
+            print(f"Skipping geology={row['Geology']} L_borehole={row['L_borehole']} m, borehole_spacing={row['borehole_spacing']} m, E_annual={record['E_max']} MWh")
+            data_frame.loc[i, ["E_max", "R_squared", "RMSE", "backend"]] = [record["E_max"], record["R_squared"], record["RMSE"], record["backend"]]
+            continue
+        else:
+            print(f"Calculating geology={row['Geology']} L_borehole={row['L_borehole']} m, borehole_spacing={row['borehole_spacing']} m")
+
+        if backend == "comsol":
+            make_model = lambda: init_model(client, params, geology, mesh=mesh)
+        elif backend == "analytical":
+            make_model = lambda: analytical.init_model(params, geology)
+        else:
+            make_model = lambda: native.init_model(params, geology, mesh=mesh, axisymmetric=backend=="axisymmetric")
 
         # This is a cheap solution to the minimization problem in Eq. (5).
         # Using, for example, scipy.optimize.fminbound() would require 10-20
         # COMSOL simulations to be run which would be very time consuming.
         # Instead, we can take advantage of the observation that the borehole
         # wall temperature is linear in the maximal annually extractable energy.
-        # So, we can calculate just 3 points and fit a regression line to those
-        # points: T_wall = p[0] * E_annual + p[1], where p is a regression line
+        # With superposition, a single simulation gives the unit load response
+        # T_ave(t) = T_undisturbed(t) + E_annual * T_unit(t), from which E_max
+        # follows in closed form for any T_min. Otherwise, we calculate just 3
+        # points and fit a regression line to those points:
+        # T_wall = p[0] * E_annual + p[1], where p is a regression line
         # fit to the data points using np.polyfit(). Now E_max can be found as:
         # E_max = (T_min - p[1]) / p[0], where T_min is the minimal allowed
         # temperature of the borehole wall.
 
-        x = [10, 30, np.nan]
-        y = [np.nan, np.nan, np.nan]
+        if superposition:
+
+            # The response is cached under a hash of the geology, the
+            # parameters and the backend version, so reruns are free.
+            response = eval_cached_response(cache, key, make_model, T_min, case=describe_case(params, geology), backend=backend_version)
+
+            E_max = response.E_max(T_min)
+
+            R_squared, RMSE = np.nan, np.nan
+
+            x = [E_max]
+            y = [T_min]
 
-        for j in range(len(x)):
-            y[j] = eval_temp(model, x[j])
-            if j == 1:
-                p = np.polyfit(x[0:2], y[0:2], 1)
-                x[2] = -p[1] / p[0]
+            xi = np.linspace(0, 1.05*E_max, 1000)
+            yi = response.T_min(xi)
 
-        p = np.polyfit(x, y, 1)
+        else:
+
+            model = make_model()
+
+            x = [10, 30, np.nan]
+            y = [np.nan, np.nan, np.nan]
 
-        SS_res = np.sum((y - np.polyval(p, x))**2)
-        SS_tot = np.sum((y - np.mean(y))**2)
+            for j in range(len(x)):
+                y[j] = eval_temp(model, x[j])
+                if j == 1:
+                    p = np.polyfit(x[0:2], y[0:2], 1)
+                    x[2] = -p[1] / p[0]
 
-        R_squared = 1 - SS_res / SS_tot
+            p = np.polyfit(x, y, 1)
 
-        RMSE = np.sqrt(np.mean((y - np.polyval(p, x))**2))
+            SS_res = np.sum((y - np.polyval(p, x))**2)
+            SS_tot = np.sum((y - np.mean(y))**2)
 
-        xi = np.linspace(0.95*np.min(x), 1.05*np.max(x), 1000)
-        yi = np.polyval(p, xi)
+            R_squared = 1 - SS_res / SS_tot
 
-        E_max = (T_min - p[1]) / p[0]
+            RMSE = np.sqrt(np.mean((y - np.polyval(p, x))**2))
+
+            xi = np.linspace(0.95*np.min(x), 1.05*np.max(x), 1000)
+            yi = np.polyval(p, xi)
+
+            E_max = (T_min - p[1]) / p[0]
 
         if plot_fits:
             plt.figure()
@@ -100,8 +182,10 @@ def calculate_potentials(with_groundwater_flow, plot_fits=False):
 
         print(f"Result E_max={E_max:.3f} R_squared={R_squared:.6f} RMSE={RMSE:.6f}")
 
-        data_frame.loc[i, ["E_max", "R_squared", "RMSE"]] = [E_max, R_squared, RMSE]
-        data_frame.to_excel(file_name, index=False)
+        data_frame.loc[i, ["E_max", "R_squared", "RMSE", "backend"]] = [E_max, R_squared, RMSE, backend_version]
+        store.append(table, key, {"Geology": row["Geology"], "L_borehole": row["L_borehole"], "borehole_spacing": row["borehole_spacing"], "E_max": E_max, "R_squared": R_squared, "RMSE": RMSE, "backend": backend_version})
+
+    data_frame.to_excel(file_name, index=False)
 
 if __name__ == "__main__":
 
@@ -0,0 +1,85 @@
+# =================================================================================
+# This script is used to map the potentials over a region of stratigraphic columns
+# =================================================================================
+
+from scheduler import AnalyticalBackend, ComsolBackend, NativeBackend, Scheduler
+from regional import InvalidColumn, read_columns, tile_of, export_tiles
+from cache import case_hash, stable_hash
+from results import ResultStore
+from comsol import Parameters
+from itertools import count, product
+import os
+
+
+os.environ["KMP_DUPLICATE_LIB_OK"] = "True" # Gets rid of the annoying OpenMP initialization error.
+
+
+def calculate_regional_potentials(file_name, backend="analytical", L_boreholes=(100, 200, 300), borehole_spacings=(20, 50, 100), tile_size=10000, directory="tiles", num_workers=4, T_min=0.0):
+    """Calculates E_max for every stratigraphic column of a gridded model directory or a CSV file and every borehole length and spacing.
+
+    The columns are read lazily and streamed through the backend by a scheduler, so the memory use does not grow with
+    the number of columns. Each finished case is appended to the results store, and the cases found there are skipped,
+    so an interrupted run continues where it stopped. Finally the results are written to one file per tile."""
+
+    monthly_fractions = [0.194717, 0.17216, 0.128944, 0.075402, 0.024336, 0, 0, 0, 0.025227, 0.076465, 0.129925, 0.172824]
+
+    if backend == "analytical":
+        backend = AnalyticalBackend(T_min)
+    elif backend == "native":
+        backend = NativeBackend(T_min)
+    elif backend == "comsol":
+        backend = ComsolBackend(T_min)
+    else:
+        raise ValueError(f"Unknown backend: {backend}")
+
+    # The results depend on T_min as well as on the backend, so both are stored in the backend column and the resume
+    # keys, and the tiles are exported only from the records of this run.
+    version = f"{backend.version}+T_min-{T_min}"
+
+    store = ResultStore()
+    table = "regional_potentials"
+    store.create_table(table, {"Location": "TEXT", "x": "REAL", "y": "REAL", "tile": "TEXT", "L_borehole": "REAL", "borehole_spacing": "REAL", "E_max": "REAL", "backend": "TEXT", "error": "TEXT"})
+
+    # The records of the cases handed to the scheduler by their index, which the scheduler keeps no more than
+    # max_pending of at a time.
+    pending = {}
+    num_skipped, num_failed, num_invalid = 0, 0, 0
+
+    def cases():
+        nonlocal num_skipped, num_invalid
+        index = count()
+        for x, y, geology in read_columns(file_name):
+            if isinstance(geology, InvalidColumn):
+                # The column is recorded with its error instead of E_max, so it shows up in the output.
+                num_invalid += 1
+                for L_borehole, borehole_spacing in product(L_boreholes, borehole_spacings):
+                    key = stable_hash({"location": geology.name, "error": geology.error, "L_borehole": L_borehole, "borehole_spacing": borehole_spacing, "backend": version})
+                    store.append(table, key, {"Location": geology.name, "x": x, "y": y, "tile": tile_of(x, y, tile_size), "L_borehole": L_borehole, "borehole_spacing": borehole_spacing, "E_max": None, "backend": version, "error": geology.error})
+                continue
+            for L_borehole, borehole_spacing in product(L_boreholes, borehole_spacings):
+                params = Parameters(L_borehole=L_borehole, D_borehole=0.150, borehole_spacing=borehole_spacing, E_annual=0, num_years=50, monthly_fractions=monthly_fractions)
+                # The case hash leaves out names, so the location is added to tell identical columns apart.
+                key = stable_hash({"location": geology.name, "case": case_hash(params, geology, version)})
+                if (table, key) in store:
+                    num_skipped += 1
+                    continue
+                pending[next(index)] = (key, {"Location": geology.name, "x": x, "y": y, "tile": tile_of(x, y, tile_size), "L_borehole": L_borehole, "borehole_spacing": borehole_spacing, "backend": version})
+                yield geology, params
+
+    for i, _, result in Scheduler(backend, num_workers=num_workers, journal=None).run(cases()):
+        key, record = pending.pop(i)
+        if result is None:
+            num_failed += 1
+            continue
+        store.append(table, key, {**record, "E_max": result["E_max"]})
+
+    print(f"Skipped {num_skipped} finished cases, {num_failed} cases failed, {num_invalid} columns were invalid.")
+
+    export_tiles(store, table, directory, backend=version)
+
+
+if __name__ == "__main__":
+
+    import sys
+
+    calculate_regional_potentials(sys.argv[1], *sys.argv[2:3])
@@ -0,0 +1,69 @@
+from comsol import Parameters, init_model
+from superposition import eval_response
+from budapest import make_geologies
+from metrics import CaseMetrics
+from geology import truncation_depth
+import pandas as pd
+import numpy as np
+import native, os
+
+
+os.environ["KMP_DUPLICATE_LIB_OK"] = "True" # Gets rid of the annoying OpenMP initialization error.
+
+
+def calculate_truncation_error(truncations=(1, 2, 3), with_groundwater_flow=False, L_borehole=200, borehole_spacing=20, backend="native", T_min=0.0):
+    """Solves E_max for each Budapest geology with the full depth and with the domain truncated at the specified numbers of diffusion lengths below the borehole and returns the differences together with the costs."""
+
+    monthly_fractions = [0.194717, 0.17216, 0.128944, 0.075402, 0.024336, 0, 0, 0, 0.025227, 0.076465, 0.129925, 0.172824]
+
+    geologies = make_geologies(v_groundwater="predefined" if with_groundwater_flow else 0)
+
+    if backend == "comsol":
+        import mph
+        client = mph.start(cores=8)
+    elif backend != "native":
+        raise ValueError(f"Unknown backend: {backend}")
+
+    params = Parameters(L_borehole=L_borehole, D_borehole=0.150, borehole_spacing=borehole_spacing, E_annual=0, num_years=50, monthly_fractions=monthly_fractions)
+
+    records = []
+
+    for geology in geologies:
+
+        for truncation in [None] + list(truncations):
+
+            print(f"Calculating geology={geology.name}, truncation={truncation}")
+
+            metrics = CaseMetrics(geology.name)
+
+            if backend == "comsol":
+                model = init_model(client, params, geology, metrics, truncation=truncation)
+            else:
+                model = native.init_model(params, geology, metrics, truncation=truncation)
+
+            response = eval_response(model, metrics=metrics)
+
+            if backend == "comsol":
+                client.clear()
+
+            record = metrics.to_dict()
+            record.update(geology=geology.name, truncation=np.nan if truncation is None else truncation, depth=geology.thickness if truncation is None else truncation_depth(geology, L_borehole, params.num_years, truncation), E_max=response.E_max(T_min), time_total=sum(metrics.phases.values()))
+            records.append(record)
+
+    data_frame = pd.DataFrame(records)
+
+    E_full = data_frame[data_frame["truncation"].isna()].set_index("geology")["E_max"]
+
+    data_frame["E_max_difference"] = data_frame["E_max"] / data_frame["geology"].map(E_full) - 1
+
+    return data_frame
+
+
+if __name__ == "__main__":
+
+    data_frame = calculate_truncation_error()
+
+    data_frame.to_excel("results_truncation_error.xlsx", index=False)
+
+    for _, row in data_frame.iterrows():
+        print(f"geology={row['geology']}, truncation={row['truncation']}, num_dofs={row['num_dofs']:,}, time_total={row['time_total']:.1f}s, E_max={row['E_max']:.3f} MWh, E_max_difference={100*row['E_max_difference']:.4f}%")
@@ -0,0 +1,38 @@
+from monte_carlo import run_monte_carlo
+from budapest import make_geologies
+from comsol import Parameters
+import pandas as pd
+import os
+
+
+os.environ["KMP_DUPLICATE_LIB_OK"] = "True" # Gets rid of the annoying OpenMP initialization error.
+
+
+def calculate_uncertainty(with_groundwater_flow, L_borehole=200, borehole_spacing=20, T_min=0.0, rtol=0.01, max_samples=1024, seed=None):
+    """Runs Monte Carlo simulations of E_max for each Budapest site and returns the P10, P50 and P90 values per site."""
+
+    monthly_fractions = [0.194717, 0.17216, 0.128944, 0.075402, 0.024336, 0, 0, 0, 0.025227, 0.076465, 0.129925, 0.172824]
+
+    geologies = make_geologies(v_groundwater="predefined" if with_groundwater_flow else 0)
+
+    params = Parameters(L_borehole=L_borehole, D_borehole=0.150, borehole_spacing=borehole_spacing, E_annual=0, num_years=50, monthly_fractions=monthly_fractions)
+
+    records = []
+
+    for geology in geologies:
+
+        for summary in run_monte_carlo(params, geology, seed=seed, T_min=T_min, rtol=rtol, max_samples=max_samples):
+            print(f"geology={geology.name}, num_samples={summary['num_samples']}, P10={summary['P10']:.3f} MWh, P50={summary['P50']:.3f} MWh, P90={summary['P90']:.3f} MWh, P50_error={100*summary['P50_error']:.2f}%")
+
+        records.append({"Geology": geology.name, "L_borehole": L_borehole, "borehole_spacing": borehole_spacing, **summary})
+
+    return pd.DataFrame(records)
+
+
+if __name__ == "__main__":
+
+    data_frame = calculate_uncertainty(with_groundwater_flow=False)
+    data_frame.to_excel("results_uncertainty_without_groundwater_flow.xlsx", index=False)
+
+    data_frame = calculate_uncertainty(with_groundwater_flow=True)
+    data_frame.to_excel("results_uncertainty_with_groundwater_flow.xlsx", index=False)
@@ -1,9 +1,15 @@
 from utils import num_to_str, time_elapsed
-from geology import PorousMaterial, PorousLayer
+from geology import PorousMaterial, PorousLayer, truncation_depth
+from metrics import CaseMetrics
+from mesh import get_policy
+from cache import stable_hash
 import numpy as np
 import time
 
 
+BACKEND_VERSION = "comsol-1" # Change this when the model changes so that cached results are invalidated.
+
+
 class Parameters:
     """This class is used to store model parameters regarding the borehole and heat extraction from it."""
 
@@ -28,7 +34,7 @@ class Parameters:
         return f"Parameters({descr})"
 
 
-def eval_temp(model, E_annual):
+def eval_temp(model, E_annual, metrics=None):
     """Evaluates the coldest mean borehole wall temperature during a simulation using the specified heat extraction."""
     tic = time.time()
     model.parameter("E_annual", f"{num_to_str(E_annual)}[MWh]")
@@ -36,20 +42,32 @@ def eval_temp(model, E_annual):
     T_ave = model.evaluate("T_ave", "degC")
     temp = np.min(T_ave)
     toc = time.time()
+    if metrics is not None:
+        metrics.record_solve(toc-tic)
     print(f"time_elapsed={time_elapsed(toc-tic)}, E_annual={num_to_str(E_annual)} MWh, temp={num_to_str(temp)} \xb0C")
     return temp
 
 
-def init_model(client, params, geology):
-    """Constructs a new COMSOL model using the specified client having the specified parameters for simulating heat extraction from the specified geology."""
+def init_model(client, params, geology, metrics=None, mesh=None, truncation=None):
+    """Constructs a new COMSOL model using the specified client having the specified parameters for simulating heat extraction from the specified geology.
+
+    The mesh resolution is given by a MeshPolicy or the name of one and defaults to the standard policy. If truncation
+    is specified, the domain ends that many diffusion lengths below the borehole instead of at the bottom of the geology.
+    The durations of the construction phases and the mesh size are collected into the specified CaseMetrics if any."""
+
+    if metrics is None:
+        metrics = CaseMetrics(geology.name)
+
+    mesh = get_policy(mesh)
+
+    if truncation is not None:
+        geology = geology.truncate(truncation_depth(geology, params.L_borehole, params.num_years, truncation))
 
     # -------------------------------------------------------------------------
     # Creates a new COMSOL model.
     # -------------------------------------------------------------------------
 
-    print("Creating a new COMSOL model...", end=" ")
-
-    tic = time.time()
+    metrics.start("model", "Creating a new COMSOL model...")
 
     model = client.create(f"Model of {geology.name}")
 
@@ -57,17 +75,13 @@ def init_model(client, params, geology):
     model.java.component("comp1").geom().create("geom1", 3)
     model.java.component("comp1").mesh().create("mesh1")
 
-    toc = time.time()
-
-    print(f"Done in {time_elapsed(toc-tic)}.")
+    metrics.stop()
 
     # -------------------------------------------------------------------------
     # Sets up model parameters.
     # -------------------------------------------------------------------------
 
-    print("Setting up model parameters...", end=" ")
-
-    tic = time.time()
+    metrics.start("parameters", "Setting up model parameters...")
 
     model.java.param().set("H_model", f"{num_to_str(geology.thickness)}[m]")
 
@@ -97,17 +111,13 @@ def init_model(client, params, geology):
             if layer.velocity > 0:
                 model.java.param().set(f"v_{layer.tag}", f"{num_to_str(layer.velocity)}[m/s]")
 
-    toc = time.time()
-
-    print(f"Done in {time_elapsed(toc-tic)}.")
+    metrics.stop()
 
     # -------------------------------------------------------------------------
     # Creates initial temperature function.
     # -------------------------------------------------------------------------
 
-    print("Creating functions...", end=" ")
-
-    tic = time.time()
+    metrics.start("functions", "Creating functions...")
 
     pieces = []
 
@@ -155,17 +165,13 @@ def init_model(client, params, geology):
         model.java.func("pw2").set("argunit", "a")
         model.java.func("pw2").set("fununit", "1")
 
-    toc = time.time()
-
-    print(f"Done in {time_elapsed(toc-tic)}.")
+    metrics.stop()
 
     # -------------------------------------------------------------------------
     # Creates model geometry.
     # -------------------------------------------------------------------------
 
-    print("Creating model geometry...", end=" ")
-
-    tic = time.time()
+    metrics.start("geometry", "Creating model geometry...")
 
     split_geology = geology.split(-params.L_borehole)
 
@@ -193,17 +199,13 @@ def init_model(client, params, geology):
 
     model.java.component("comp1").geom("geom1").run()
 
-    toc = time.time()
-
-    print(f"Done in {time_elapsed(toc-tic)}.")
+    metrics.stop()
 
     # -------------------------------------------------------------------------
     # Creates selections.
     # -------------------------------------------------------------------------
 
-    print("Creating selections...", end=" ")
-
-    tic = time.time()
+    metrics.start("selections", "Creating selections...")
 
     model.java.component("comp1").selection().create("ground_surface_selection", "Box")
     model.java.component("comp1").selection("ground_surface_selection").label("Ground Surface Selection")
@@ -283,24 +285,20 @@ def init_model(client, params, geology):
     model.java.component("comp1").selection("left_and_right_boundaries_selection").set("entitydim", "2")
     model.java.component("comp1").selection("left_and_right_boundaries_selection").set("input", ["left_boundary_selection", "right_boundary_selection"])
 
-    toc = time.time()
-
-    print(f"Done in {time_elapsed(toc-tic)}.")
+    metrics.stop()
 
     # -------------------------------------------------------------------------
     # Creates mesh.
     # -------------------------------------------------------------------------
 
-    print("Creating mesh...", end=" ")
-
-    tic = time.time()
+    metrics.start("mesh", "Creating mesh...")
 
     model.java.component("comp1").mesh("mesh1").create("collar_edge", "Edge")
     model.java.component("comp1").mesh("mesh1").feature("collar_edge").selection().named("collar_edge_selection")
     model.java.component("comp1").mesh("mesh1").feature("collar_edge").label("Collar Edge Mesh")
 
     model.java.component("comp1").mesh("mesh1").feature("collar_edge").create("dis1", "Distribution")
-    model.java.component("comp1").mesh("mesh1").feature("collar_edge").feature("dis1").set("numelem", "10")
+    model.java.component("comp1").mesh("mesh1").feature("collar_edge").feature("dis1").set("numelem", str(mesh.collar_elements))
 
     model.java.component("comp1").mesh("mesh1").create("ground_surface_mesh", "FreeTri")
     model.java.component("comp1").mesh("mesh1").feature("ground_surface_mesh").selection().named("ground_surface_selection")
@@ -310,7 +308,7 @@ def init_model(client, params, geology):
     model.java.component("comp1").mesh("mesh1").feature("ground_surface_mesh").create("size1", "Size")
     model.java.component("comp1").mesh("mesh1").feature("ground_surface_mesh").feature("size1").set("custom", "on")
     model.java.component("comp1").mesh("mesh1").feature("ground_surface_mesh").feature("size1").set("hgradactive", "on")
-    model.java.component("comp1").mesh("mesh1").feature("ground_surface_mesh").feature("size1").set("hgrad", "1.2")
+    model.java.component("comp1").mesh("mesh1").feature("ground_surface_mesh").feature("size1").set("hgrad", num_to_str(mesh.surface_hgrad))
 
     model.java.component("comp1").mesh("mesh1").create("swept_mesh", "Sweep")
     model.java.component("comp1").mesh("mesh1").feature("swept_mesh").selection().named("sweep_domains_selection")
@@ -324,41 +322,40 @@ def init_model(client, params, geology):
         if layer.z_from <= -params.L_borehole:
             break
 
-        num_elem = int(np.max([20, np.ceil(layer.thickness/5)]))
+        num_elem = mesh.num_layer_elements(layer.thickness)
 
         model.java.component("comp1").mesh("mesh1").feature("swept_mesh").create(f"dis{i+1}", "Distribution")
         model.java.component("comp1").mesh("mesh1").feature("swept_mesh").feature(f"dis{i+1}").set("type", "predefined")
         model.java.component("comp1").mesh("mesh1").feature("swept_mesh").feature(f"dis{i+1}").set("growthrate", "exponential")
         model.java.component("comp1").mesh("mesh1").feature("swept_mesh").feature(f"dis{i+1}").set("elemcount", str(num_elem))
-        model.java.component("comp1").mesh("mesh1").feature("swept_mesh").feature(f"dis{i+1}").set("elemratio", "10")
+        model.java.component("comp1").mesh("mesh1").feature("swept_mesh").feature(f"dis{i+1}").set("elemratio", num_to_str(mesh.elemratio))
         model.java.component("comp1").mesh("mesh1").feature("swept_mesh").feature(f"dis{i+1}").set("symmetric", "on")
         model.java.component("comp1").mesh("mesh1").feature("swept_mesh").feature(f"dis{i+1}").selection().named(f"{layer.tag}_selection")
 
     model.java.component("comp1").mesh("mesh1").create("tetrahedral_mesh", "FreeTet")
 
     model.java.component("comp1").mesh("mesh1").feature("tetrahedral_mesh").create("size1", "Size")
-    model.java.component("comp1").mesh("mesh1").feature("tetrahedral_mesh").feature("size1").set("hauto", "1")
+    model.java.component("comp1").mesh("mesh1").feature("tetrahedral_mesh").feature("size1").set("hauto", str(mesh.hauto))
     model.java.component("comp1").mesh("mesh1").feature("tetrahedral_mesh").feature("size1").set("custom", "on")
-    model.java.component("comp1").mesh("mesh1").feature("tetrahedral_mesh").feature("size1").set("hgrad", "1.1")
+    model.java.component("comp1").mesh("mesh1").feature("tetrahedral_mesh").feature("size1").set("hgrad", num_to_str(mesh.volume_hgrad))
     model.java.component("comp1").mesh("mesh1").feature("tetrahedral_mesh").feature("size1").set("hgradactive", "on")
 
     model.java.component("comp1").mesh("mesh1").run()
 
-    toc = time.time()
-
-    print(f"Done in {time_elapsed(toc-tic)}.")
+    metrics.stop()
 
     num_elems = model.java.component("comp1").mesh("mesh1").stat().getNumElem()
 
-    print(f"Number of elements: {num_elems:,}")
+    metrics.record(num_elements=num_elems)
+
+    if metrics.verbose:
+        print(f"Number of elements: {num_elems:,}")
 
     # -------------------------------------------------------------------------
     # Creates physics.
     # -------------------------------------------------------------------------
 
-    print("Creating physics...", end=" ")
-
-    tic = time.time()
+    metrics.start("physics", "Creating physics...")
 
     model.java.component("comp1").physics().create("ht", "PorousMediaHeatTransfer", "geom1")
 
@@ -433,17 +430,13 @@ def init_model(client, params, geology):
         model.java.component("comp1").physics("ht").feature("pc1").create("dd1", "DestinationDomains", 2)
         model.java.component("comp1").physics("ht").feature("pc1").feature("dd1").selection().named("left_boundary_selection")
 
-    toc = time.time()
-
-    print(f"Done in {time_elapsed(toc-tic)}.")
+    metrics.stop()
 
     # -------------------------------------------------------------------------
     # Creates operators and variables.
     # -------------------------------------------------------------------------
 
-    print("Creating operators and variables...", end=" ")
-
-    tic = time.time()
+    metrics.start("variables", "Creating operators and variables...")
 
     model.java.component("comp1").cpl().create("borehole_wall_integration", "Integration")
     model.java.component("comp1").cpl("borehole_wall_integration").label("Borehole Wall Integration")
@@ -471,17 +464,13 @@ def init_model(client, params, geology):
     else:
         model.java.component("comp1").variable("var1").set("Q_extraction", "E_annual/1[a]")
 
-    toc = time.time()
-
-    print(f"Done in {time_elapsed(toc-tic)}.")
+    metrics.stop()
 
     # -------------------------------------------------------------------------
     # Creates solution and solver.
     # -------------------------------------------------------------------------
 
-    print("Creating solution and solver...", end=" ")
-
-    tic = time.time()
+    metrics.start("solver", "Creating solution and solver...")
 
     tlist = f"range(0,1/12,{params.num_years})"
 
@@ -524,18 +513,81 @@ def init_model(client, params, geology):
     else:
         model.java.sol("sol1").feature("t1").set("tstepsbdf", "strict")
 
-    toc = time.time()
-
-    print(f"Done in {time_elapsed(toc-tic)}.")
+    metrics.stop()
 
     xmi = model.java.sol("sol1").feature("st1").xmeshInfo()
 
     num_dofs = xmi.nDofs()
 
-    print(f"Number of degrees of freedom: {num_dofs:,}")
+    metrics.record(num_dofs=num_dofs)
+
+    if metrics.verbose:
+        print(f"Number of degrees of freedom: {num_dofs:,}")
 
     return model
 
+
+def update_model(model, old_params, new_params, metrics=None):
+    """Updates a model constructed by init_model() to new parameters re-running only the steps that the change invalidates.
+
+    Only the borehole spacing and the annual heat extraction can be changed. The geometry and the mesh are rebuilt only if
+    the borehole spacing changes, since the geometry, the selections and the physics refer to it by parameter."""
+
+    if metrics is None:
+        metrics = CaseMetrics()
+
+    for name in ["L_borehole", "D_borehole", "num_years", "monthly_fractions"]:
+        if np.any(np.asarray(getattr(old_params, name)) != np.asarray(getattr(new_params, name))):
+            raise ValueError(f"Changing {name} requires a new model.")
+
+    model.java.param().set("E_annual", f"{num_to_str(new_params.E_annual)}[MWh]")
+
+    if new_params.borehole_spacing != old_params.borehole_spacing:
+
+        metrics.start("update", "Updating model geometry and mesh...")
+
+        model.java.param().set("borehole_spacing", f"{num_to_str(new_params.borehole_spacing)}[m]")
+
+        model.java.component("comp1").geom("geom1").run()
+        model.java.component("comp1").mesh("mesh1").run()
+
+        metrics.stop()
+
+        num_elems = model.java.component("comp1").mesh("mesh1").stat().getNumElem()
+
+        # The degrees of freedom of the old mesh would otherwise stay in the metrics.
+        num_dofs = model.java.sol("sol1").feature("st1").xmeshInfo().nDofs()
+
+        metrics.record(num_elements=num_elems, num_dofs=num_dofs)
+
+        if metrics.verbose:
+            print(f"Number of elements: {num_elems:,}")
+            print(f"Number of degrees of freedom: {num_dofs:,}")
+
+
+class ModelCache:
+    """This class keeps built models per geology and borehole length and updates them in place when only the borehole spacing or the heat extraction changes."""
+
+    def __init__(self, client, max_models=1, mesh=None):
+        self.client, self.max_models, self.mesh = client, max_models, mesh
+        self.models = {}
+
+    def get(self, params, geology, metrics=None):
+        """Returns a model for the specified parameters and geology reusing a previously built model if possible."""
+        key = stable_hash([geology, params.L_borehole, params.D_borehole, params.num_years, params.monthly_fractions])
+        if key in self.models:
+            model, old_params = self.models.pop(key)
+            update_model(model, old_params, params, metrics)
+        else:
+            while len(self.models) >= self.max_models:
+                # Removes the least recently used model from the client.
+                old_key = next(iter(self.models))
+                self.client.remove(self.models.pop(old_key)[0])
+            model = init_model(self.client, params, geology, metrics, self.mesh)
+        self.models[key] = (model, params)
+        return model
+
+
 if __name__ == "__main__":
     from geology import Geology, Layer, Material
     #from utils import save_model
@@ -1,4 +1,6 @@
 from utils import num_to_str
+import numpy as np
+import math
 
 
 class Material:
@@ -113,14 +115,21 @@ class Geology:
             self.has_groundwater_flow = True
 
     def calc_averages(self):
-        averages = {"k": 0, "Cp": 0, "rho": 0, "C": 0}
-        for layer in self.layers:
-            weight = layer.thickness / self.thickness
-            averages["k"] += weight * layer.material.k
-            averages["Cp"] += weight * layer.material.Cp
-            averages["rho"] += weight * layer.material.rho
-            averages["C"] += weight * layer.material.rho * layer.material.Cp
-        return averages
+        return self.to_arrays().averages()
+
+    def to_arrays(self):
+        """Returns a columnar view of this geology with the layer properties stored in NumPy arrays."""
+        return GeologyArrays(
+            self.name, self.T_surface, self.q_geothermal,
+            z_from=[layer.z_from for layer in self.layers],
+            z_to=[layer.z_to for layer in self.layers],
+            k=[layer.material.k for layer in self.layers],
+            Cp=[layer.material.Cp for layer in self.layers],
+            rho=[layer.material.rho for layer in self.layers],
+            porosity=[getattr(layer.material, "porosity", 0) for layer in self.layers],
+            velocity=[getattr(layer, "velocity", 0) for layer in self.layers],
+            Cp_fluid=[getattr(layer.material, "Cp_fluid", 4186) for layer in self.layers],
+            rho_fluid=[getattr(layer.material, "rho_fluid", 1000) for layer in self.layers])
 
     def add_layers(self, layers):
         """Adds a list of layers to this geology."""
@@ -134,11 +143,130 @@ class Geology:
             split_layers.extend(layer.split(z))
         return Geology(self.name, self.T_surface, self.q_geothermal, split_layers)
 
+    def truncate(self, depth):
+        """Returns a copy of this geology that ends at the specified depth. The layer crossing the depth keeps its name."""
+        truncated_layers = []
+        for layer in self.layers:
+            if layer.z_from <= -depth:
+                break
+            above = layer.split(-depth)[0]
+            above.name, above.tag = layer.name, layer.tag
+            truncated_layers.append(above)
+        return Geology(self.name, self.T_surface, self.q_geothermal, truncated_layers)
+
+    def with_velocity(self, velocity):
+        """Returns a copy of this geology with the specified groundwater flow velocity in every porous layer."""
+        layers = [PorousLayer(layer.name, layer.material, layer.z_from, layer.z_to, velocity) if type(layer) is PorousLayer else layer for layer in self.layers]
+        return Geology(self.name, self.T_surface, self.q_geothermal, layers)
+
     def __str__(self):
         layers = ", ".join([f"{layer.name} ({num_to_str(layer.thickness)} m)" for layer in self.layers])
         return f"Geology(name={self.name}, T_surface={num_to_str(self.T_surface)} \xb0C, q_geothermal={num_to_str(self.q_geothermal)} W/m\xb2, thickness={num_to_str(self.thickness)} m, layers=[{layers}])"
 
 
+class GeologyArrays:
+    """This class is a columnar view of a geology with the layer properties stored in NumPy arrays.
+
+    It has the same name, T_surface, q_geothermal, thickness and has_groundwater_flow attributes as Geology, so it can be
+    passed to the native models and hashed for the cache, but it is much cheaper to create, average and split. Scalar
+    properties are broadcast to all layers."""
+
+    def __init__(self, name, T_surface, q_geothermal, z_from, z_to, k, Cp, rho, porosity=0, velocity=0, Cp_fluid=4186, rho_fluid=1000):
+        self.name = name
+        self.T_surface, self.q_geothermal = T_surface, q_geothermal
+        arrays = np.broadcast_arrays(*[np.asarray(value, dtype=float) for value in (z_from, z_to, k, Cp, rho, porosity, velocity, Cp_fluid, rho_fluid)])
+        self.z_from, self.z_to, self.k, self.Cp, self.rho, self.porosity, self.velocity, self.Cp_fluid, self.rho_fluid = [np.atleast_1d(array).copy() for array in arrays]
+        if self.z_from[0] != 0 or np.any(self.z_from[1:] != self.z_to[:-1]) or np.any(self.z_to >= self.z_from):
+            raise ValueError("The layers must be contiguous, begin from the ground level and have positive thicknesses.")
+
+    @property
+    def thickness(self):
+        return -self.z_to[-1]
+
+    @property
+    def has_groundwater_flow(self):
+        return bool(np.any(self.velocity > 0))
+
+    @property
+    def layer_thicknesses(self):
+        return self.z_from - self.z_to
+
+    def averages(self, z_from=0, z_to=None):
+        """Returns the thickness weighted averages of the layer properties between the specified depths."""
+        z_to = -self.thickness if z_to is None else z_to
+        weights = np.maximum(np.minimum(self.z_from, z_from) - np.maximum(self.z_to, z_to), 0)
+        weights = weights / np.sum(weights)
+        return {"k": np.sum(weights*self.k), "Cp": np.sum(weights*self.Cp), "rho": np.sum(weights*self.rho), "C": np.sum(weights*self.rho*self.Cp)}
+
+    def layer_index(self, z):
+        """Returns the indices of the layers enclosing the specified vertical coordinates. Interfaces belong to the upper layer."""
+        return np.minimum(np.searchsorted(-self.z_to, -np.asarray(z), side="left"), len(self.z_to)-1)
+
+    def T_initial(self, z):
+        """Evaluates the undisturbed geotherm, whose heat flux is q_geothermal in every layer, at the specified vertical coordinates."""
+        T_top = self.T_surface + np.concatenate(([0], np.cumsum(self.q_geothermal * self.layer_thicknesses / self.k)[:-1]))
+        i = self.layer_index(z)
+        return T_top[i] + self.q_geothermal / self.k[i] * (self.z_from[i] - np.asarray(z))
+
+    def _select(self, indices, z_from, z_to):
+        arrays = self.__class__.__new__(self.__class__)
+        arrays.name, arrays.T_surface, arrays.q_geothermal = self.name, self.T_surface, self.q_geothermal
+        arrays.z_from, arrays.z_to = z_from, z_to
+        for key in ("k", "Cp", "rho", "porosity", "velocity", "Cp_fluid", "rho_fluid"):
+            setattr(arrays, key, getattr(self, key)[indices])
+        return arrays
+
+    def split(self, z):
+        """Returns a copy with a layer interface added at the specified depth."""
+        if z <= -self.thickness or z >= 0 or np.any(self.z_to == z):
+            return self._select(np.arange(len(self.z_to)), self.z_from.copy(), self.z_to.copy())
+        i = int(self.layer_index(z))
+        indices = np.insert(np.arange(len(self.z_to)), i, i)
+        return self._select(indices, np.insert(self.z_from, i+1, z), np.insert(self.z_to, i, z))
+
+    def truncate(self, depth):
+        """Returns a copy that ends at the specified depth."""
+        n = int(np.sum(self.z_from > -depth))
+        z_to = self.z_to[:n].copy()
+        z_to[-1] = max(z_to[-1], -depth)
+        return self._select(np.arange(n), self.z_from[:n].copy(), z_to)
+
+    def __str__(self):
+        return f"GeologyArrays(name={self.name}, T_surface={num_to_str(self.T_surface)} \xb0C, q_geothermal={num_to_str(self.q_geothermal)} W/m\xb2, thickness={num_to_str(self.thickness)} m, num_layers={len(self.z_to)})"
+
+
+def as_arrays(geology):
+    """Returns the columnar view of the specified Geology or GeologyArrays."""
+    return geology if isinstance(geology, GeologyArrays) else geology.to_arrays()
+
+
+def truncation_depth(geology, L_borehole, num_years, num_diffusion_lengths=3):
+    """Returns the depth below which a geology only carries the geothermal gradient during the specified number of years.
+
+    The depth is the borehole length plus the specified number of diffusion lengths sqrt(a*t) using the largest thermal
+    diffusivity of the layers below the borehole, rounded up to a whole metre. Truncating a geology at this depth keeps
+    the geothermal heat flux on the bottom boundary consistent with the initial temperature while removing the elements
+    that only carry the gradient."""
+    t_max = num_years * 31556952
+    arrays = as_arrays(geology)
+    below = arrays.z_to < -L_borehole
+    if not np.any(below):
+        return geology.thickness
+    diffusivity = np.max(arrays.k[below] / (arrays.rho[below] * arrays.Cp[below]))
+    return min(geology.thickness, math.ceil(L_borehole + num_diffusion_lengths * (diffusivity * t_max)**0.5))
+
+
+def peclet_number(geology, length, L_borehole=None):
+    """Returns the largest thermal Peclet number rho_fluid*Cp_fluid*velocity*length/k of the layers reached by the borehole.
+
+    The number compares the heat carried by groundwater flow over the specified length, typically the borehole spacing,
+    to the heat conducted over it, so groundwater flow has no noticeable effect on E_max if it is well below one. All
+    layers are considered if the borehole length is not specified."""
+    arrays = as_arrays(geology)
+    reached = arrays.z_from > (-arrays.thickness if L_borehole is None else -L_borehole)
+    return float(np.max(arrays.rho_fluid[reached] * arrays.Cp_fluid[reached] * arrays.velocity[reached] * length / arrays.k[reached]))
+
+
 if __name__ == "__main__":
     # Creates materials
     sand = PorousMaterial("Sand", 1, 1000, 1800, 0.333)
@@ -167,3 +295,7 @@ if __name__ == "__main__":
     import budapest
     for geology in budapest.make_geologies():
         print(geology.name, geology.calc_averages()["k"])
+    # Evaluates the geotherm of a columnar view of a geology.
+    arrays = geology2.to_arrays().split(-150)
+    print(arrays)
+    print(arrays.layer_index([0, -50, -100, -150, -200]), arrays.T_initial([0, -50, -100, -150, -200]))
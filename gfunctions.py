@@ -0,0 +1,181 @@
+from concurrent.futures import ProcessPoolExecutor
+from analytical import finite_line_source
+from cache import ResultCache, stable_hash
+import scipy.sparse
+import numpy as np
+
+
+VERSION = "gfunction-1" # Change this when the computation changes so that stored g-functions are invalidated.
+
+
+def _octants(N):
+    """Returns the octant of each borehole of an N x N field as an index into the unique boreholes and the positions of the unique boreholes.
+
+    The boreholes that are mapped to each other by the mirror and diagonal symmetries of the square field have equal
+    heat extraction rates, so only one of each is solved for."""
+    i = np.minimum(np.arange(N), N - 1 - np.arange(N))
+    x, y = np.meshgrid(i, i, indexing="ij")
+    p, q = np.minimum(x, y).ravel(), np.maximum(x, y).ravel()
+    unique, octant = np.unique(p * N + q, return_inverse=True)
+    return octant, unique // N, unique % N
+
+
+def _response_factors(N, B, H, r_b, alpha, time, chunk_size=64):
+    """Returns the response factors between the unique boreholes of an N x N field summed over the boreholes of each octant, one matrix per time.
+
+    The distances between the boreholes of a regular field are B*sqrt(k) for integers k, so the finite line source is
+    evaluated once per distinct k and the sums over the octants are made with a sparse matrix product."""
+    octant, p, q = _octants(N)
+    U = len(p)
+    x, y = np.meshgrid(np.arange(N), np.arange(N), indexing="ij")
+    x, y = x.ravel(), y.ravel()
+    k = (p[:, None] - x[None, :])**2 + (q[:, None] - y[None, :])**2
+    distinct, k_index = np.unique(k, return_inverse=True)
+    k_index = k_index.reshape(k.shape)
+    # The borehole itself is at the distance of its radius.
+    h_k = finite_line_source(time, np.where(distinct == 0, r_b / B, np.sqrt(distinct)) * B, H, alpha)
+    h = np.zeros((U, U, len(time)))
+    for start in range(0, U, chunk_size):
+        rows = np.arange(start, min(start + chunk_size, U))
+        pairs = (rows[:, None] - start) * U + octant[None, :]
+        counts = scipy.sparse.coo_matrix((np.ones(pairs.size), (pairs.ravel(), k_index[rows].ravel())), shape=(len(rows) * U, len(distinct))).tocsr()
+        h[rows] = (counts @ h_k).reshape((len(rows), U, len(time)))
+    return h, np.bincount(octant)
+
+
+def _reconstruct_loads(time, Q_b):
+    """Returns the load history of the segments on the time steps in reverse order having the same accumulated heat extraction."""
+    dt = np.hstack((time[0], np.diff(time)))
+    t = np.hstack((0., time, time[-1] + time[0]))
+    f = np.hstack((np.zeros((Q_b.shape[0], 1)), np.cumsum(Q_b * dt, axis=1)))
+    f = np.hstack((f, f[:, -1:]))
+    t_reconstructed = np.hstack((0., np.cumsum(dt[::-1])))
+    F = np.array([np.interp(t_reconstructed, t, row) for row in f])
+    return np.diff(F, axis=1) / dt[::-1]
+
+
+def square_field_gfunction(N, B, H, r_b, alpha, time):
+    """Returns the g-function of an N x N field with the uniform borehole wall temperature boundary condition and one segment per borehole.
+
+    The equations and the time stepping are those of pygfunction.gfunction.uniform_temperature(), but the unknowns are
+    the heat extraction rates of the unique boreholes of one octant of the field, which reduces the number of unknowns
+    by a factor of eight and the work of the temporal superposition by a factor of 64."""
+    time = np.asarray(time, dtype=float)
+    # The g-function is linearized below the threshold time like in pygfunction.
+    time_threshold = r_b**2 / (25 * alpha)
+    p_long = np.searchsorted(time, time_threshold, side="right")
+    time_long = np.concatenate(([time_threshold], time[p_long:])) if p_long > 0 else time
+    h, multiplicity = _response_factors(N, B, H, r_b, alpha, time_long)
+    U = len(multiplicity)
+    H_b = multiplicity * H
+    H_tot = np.sum(H_b)
+    t_h = np.concatenate(([0.], time_long))
+    Q_b = np.zeros((U, len(time_long)))
+    g = np.zeros(len(time_long))
+    for n in range(len(time_long)):
+        dt = time_long[n] - time_long[n-1] if n > 0 else time_long[n]
+        # The response factors are interpolated linearly in time to the time step.
+        j = min(np.searchsorted(t_h, dt, side="right"), len(t_h) - 1)
+        w = (dt - t_h[j-1]) / (t_h[j] - t_h[j-1])
+        h_dt = w * h[:, :, j-1] + ((1 - w) * h[:, :, j-2] if j > 1 else 0)
+        Q_reconstructed = _reconstruct_loads(time_long[:n+1], Q_b[:, :n+1])
+        dQ = np.diff(Q_reconstructed, axis=1, prepend=0)[:, ::-1]
+        T_b0 = np.einsum("ijk,jk", h[:, :, :n+1], dQ)
+        A = np.block([[h_dt, -np.ones((U, 1))], [H_b, 0.]])
+        X = np.linalg.solve(A, np.hstack((-T_b0, H_tot)))
+        Q_b[:, n], g[n] = X[:U], X[-1]
+    if p_long > 0:
+        return np.concatenate((g[0] * time[:p_long] / time_threshold, g[1:]))
+    return g
+
+
+def extrapolate_gfunction(N, g, order=3):
+    """Returns the g-function of the infinite field extrapolated from the g-functions of N x N fields, an estimate of its error and the coefficients of the fit.
+
+    The share of the boreholes near the edges, which have fewer neighbours, is proportional to the perimeter over the
+    area, so the g-function approaches its limit as a series in 1/N. The series is fitted at each time by least squares
+    and the error is estimated as the change of the limit when the series is extended by one term, which needs at least
+    order+2 field sizes."""
+    N, g = np.asarray(N, dtype=float), np.asarray(g, dtype=float)
+    if len(N) < order + 2:
+        raise ValueError(f"At least {order+2} field sizes are needed for order {order}.")
+    coefficients = np.linalg.lstsq(np.vander(1 / N, order+1, increasing=True), g, rcond=None)[0]
+    extended = np.linalg.lstsq(np.vander(1 / N, order+2, increasing=True), g, rcond=None)[0]
+    return coefficients[0], np.abs(extended[0] - coefficients[0]), coefficients
+
+
+def asymptotic_gfunction(coefficients, N):
+    """Returns the g-functions of N x N fields given by the series fitted by extrapolate_gfunction() as rows of an array."""
+    return np.vander(1 / np.atleast_1d(np.asarray(N, dtype=float)), len(coefficients), increasing=True) @ coefficients
+
+
+def _compute(args):
+    return square_field_gfunction(*args)
+
+
+class GFunctionService:
+    """This class stores g-functions of square fields on the local disk and computes the missing ones in parallel.
+
+    The g-functions are stored in a ResultCache under a hash of the field size, the borehole spacing, the borehole length
+    and radius, the thermal diffusivity and the time grid."""
+
+    def __init__(self, directory="gfunctions", max_workers=None, max_bytes=1024**3):
+        self.cache = ResultCache(directory, max_bytes)
+        self.max_workers = max_workers
+
+    @staticmethod
+    def key(N, B, H, r_b, alpha, time):
+        """Returns the key of the g-function of the specified field."""
+        return stable_hash({"N": N, "B": B, "H": H, "r_b": r_b, "alpha": alpha, "time": np.asarray(time), "version": VERSION})
+
+    def get(self, N, B, H, r_b, alpha, time):
+        """Returns the g-function of an N x N field computing and storing it if needed."""
+        return self.get_many([N], [B], H, r_b, alpha, time)[0]
+
+    def get_many(self, N, B, H, r_b, alpha, time, max_workers=None):
+        """Returns the g-functions of N x N fields for the specified pairs of N and B as rows of an array.
+
+        The missing g-functions are computed in a process pool of max_workers processes, or of the default of the service
+        if not specified, largest fields first so that the pool stays busy."""
+        N, B = np.broadcast_arrays(np.atleast_1d(N), np.atleast_1d(B))
+        cases = [(int(n), float(b), float(H), float(r_b), float(alpha), np.asarray(time, dtype=float)) for n, b in zip(N, B)]
+        keys = [self.key(*case) for case in cases]
+        g = [None] * len(cases)
+        missing = {}
+        for i, key in enumerate(keys):
+            entry = self.cache.get(key)
+            if entry is not None:
+                g[i] = entry["g"]
+            else:
+                missing.setdefault(key, []).append(i)
+        if len(missing) > 0:
+            order = sorted(missing, key=lambda key: -cases[missing[key][0]][0])
+            print(f"Computing {len(order)} g-functions...")
+            with ProcessPoolExecutor(max_workers=self.max_workers if max_workers is None else max_workers) as executor:
+                for key, g_key in zip(order, executor.map(_compute, [cases[missing[key][0]] for key in order])):
+                    self.cache.put(key, {"g": g_key})
+                    for i in missing[key]:
+                        g[i] = g_key
+        return np.array(g)
+
+
+if __name__ == "__main__":
+    import pygfunction
+    import tempfile
+    import time as timer
+    H, r_b, alpha = 200.0, 0.075, 2.3 / (2800 * 850)
+    t = pygfunction.utilities.time_geometric(730*3600, 50*365*24*3600, 50)
+    # Compares with pygfunction.
+    for N in [1, 2, 5, 10, 15]:
+        field = pygfunction.boreholes.rectangle_field(N_1=N, N_2=N, B_1=20, B_2=20, H=H, D=0, r_b=r_b)
+        tic = timer.perf_counter()
+        g_reference = pygfunction.gfunction.uniform_temperature(field, t, alpha, nSegments=1, disp=False)
+        toc = timer.perf_counter()
+        g = square_field_gfunction(N, 20, H, r_b, alpha, t)
+        print(f"N={N}, pygfunction={toc-tic:.2f}s, symmetric={timer.perf_counter()-toc:.2f}s, max_error={np.max(np.abs(g/g_reference-1)):.2e}")
+    # Sweeps the field sizes twice.
+    service = GFunctionService(tempfile.mkdtemp())
+    for i in range(2):
+        tic = timer.perf_counter()
+        g = service.get_many(np.arange(1, 41), 20, H, r_b, alpha, t)
+        print(f"N=1..40, time_elapsed={timer.perf_counter()-tic:.2f}s, g_max={g[-1, -1]:.3f}")
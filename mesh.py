@@ -0,0 +1,63 @@
+from utils import num_to_str
+from cache import stable_hash
+import numpy as np
+
+
+class MeshPolicy:
+    """This class is used to store the mesh resolution of the unit cell models.
+
+    The defaults reproduce the mesh that init_model() has always used: 10 elements on the collar edge, growth rates of
+    1.2 on the ground surface and 1.1 in the volume and swept elements of about 5 m, but at least 20 per layer."""
+
+    def __init__(self, name="custom", collar_elements=10, surface_hgrad=1.2, volume_hgrad=1.1, hauto=1, layer_element_size=5.0, min_layer_elements=20, elemratio=10):
+        self.name = name
+        self.collar_elements = collar_elements
+        self.surface_hgrad = surface_hgrad
+        self.volume_hgrad = volume_hgrad
+        self.hauto = hauto
+        self.layer_element_size = layer_element_size
+        self.min_layer_elements = min_layer_elements
+        self.elemratio = elemratio
+
+    def num_layer_elements(self, thickness):
+        """Returns the number of swept elements in a layer having the specified thickness."""
+        return int(np.max([self.min_layer_elements, np.ceil(thickness/self.layer_element_size)]))
+
+    def native_kwargs(self, params):
+        """Returns the keyword arguments giving a native model a comparable resolution."""
+        return {"h_borehole": 40 * params.D_borehole / self.collar_elements, "growth": self.surface_hgrad, "dz_max": self.layer_element_size}
+
+    def refine(self, factor, name=None):
+        """Returns a policy whose element sizes are divided by the specified factor."""
+        return MeshPolicy(name or f"{self.name}/{num_to_str(factor)}", collar_elements=int(np.ceil(self.collar_elements*factor)), surface_hgrad=1+(self.surface_hgrad-1)/factor, volume_hgrad=1+(self.volume_hgrad-1)/factor, hauto=self.hauto, layer_element_size=self.layer_element_size/factor, min_layer_elements=int(np.ceil(self.min_layer_elements*factor)), elemratio=self.elemratio)
+
+    def __str__(self):
+        return f"MeshPolicy(name={self.name}, collar_elements={self.collar_elements}, surface_hgrad={num_to_str(self.surface_hgrad)}, volume_hgrad={num_to_str(self.volume_hgrad)}, hauto={self.hauto}, layer_element_size={num_to_str(self.layer_element_size)} m, min_layer_elements={self.min_layer_elements}, elemratio={num_to_str(self.elemratio)})"
+
+
+POLICIES = {
+    "coarse":   MeshPolicy("coarse",   collar_elements=6,  surface_hgrad=1.4,  volume_hgrad=1.3,  hauto=3, layer_element_size=10.0, min_layer_elements=10),
+    "standard": MeshPolicy("standard"),
+    "fine":     MeshPolicy("fine",     collar_elements=16, surface_hgrad=1.1,  volume_hgrad=1.05, hauto=1, layer_element_size=2.5,  min_layer_elements=40),
+}
+
+
+def get_policy(mesh=None):
+    """Returns the mesh policy with the specified name or the specified policy itself. None stands for the standard policy."""
+    if mesh is None:
+        return POLICIES["standard"]
+    elif isinstance(mesh, MeshPolicy):
+        return mesh
+    elif mesh in POLICIES:
+        return POLICIES[mesh]
+    raise ValueError(f"Unknown mesh policy: {mesh}")
+
+
+def mesh_version(backend_version, mesh=None):
+    """Returns the backend version extended with the mesh policy, so that results with different meshes are cached separately.
+
+    The standard policy keeps the plain backend version, which keeps results cached before mesh policies existed valid."""
+    policy = get_policy(mesh)
+    if stable_hash(policy) == stable_hash(POLICIES["standard"]):
+        return backend_version
+    return f"{backend_version}+mesh-{stable_hash(policy)[:12]}"
@@ -0,0 +1,124 @@
+from utils import time_elapsed
+import json
+import time
+import sys
+import csv
+import os
+
+try:
+    import resource
+except ImportError:
+    # The resource module is not available on Windows.
+    resource = None
+
+
+def peak_memory():
+    """Returns the peak resident memory of this process in megabytes or None if it is not available."""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports the peak resident memory in bytes and Linux in kilobytes.
+    if sys.platform == "darwin":
+        return max_rss / 1024**2
+    return max_rss / 1024
+
+
+class CaseMetrics:
+    """This class collects phase durations, mesh size, degrees of freedom, solve wall time and peak memory of a simulation case."""
+
+    def __init__(self, case=None, verbose=True):
+        self.case, self.verbose = case, verbose
+        self.phases = {}
+        self.values = {}
+        self.num_solves = 0
+        self._phase = None
+
+    def start(self, name, message=None):
+        """Starts timing the named phase and prints the message if any."""
+        if self.verbose and message is not None:
+            print(message, end=" ")
+        self._phase = (name, message, time.time())
+
+    def stop(self):
+        """Stops timing the current phase and prints its duration."""
+        name, message, tic = self._phase
+        toc = time.time()
+        self.phases[name] = self.phases.get(name, 0) + toc - tic
+        self._phase = None
+        if self.verbose and message is not None:
+            print(f"Done in {time_elapsed(toc-tic)}.")
+        return toc - tic
+
+    def record(self, **values):
+        """Records named values such as the number of elements or degrees of freedom."""
+        self.values.update(values)
+
+    def record_solve(self, seconds):
+        """Records the wall time of a single solve."""
+        self.phases["solve"] = self.phases.get("solve", 0) + seconds
+        self.num_solves += 1
+
+    def to_dict(self):
+        """Returns the metrics as a flat dictionary."""
+        record = {"case": self.case}
+        record.update({f"time_{name}": seconds for name, seconds in self.phases.items()})
+        record.update(self.values)
+        record["num_solves"] = self.num_solves
+        record["peak_memory"] = peak_memory()
+        return record
+
+    def __str__(self):
+        phases = ", ".join(f"{name}={time_elapsed(seconds)}" for name, seconds in self.phases.items())
+        return f"CaseMetrics(case={self.case}, {phases}, num_solves={self.num_solves})"
+
+
+class MetricsLog:
+    """This class exports case metrics as JSON lines or CSV and passes each record to an optional callback."""
+
+    def __init__(self, path, format=None, callback=None):
+        if format is None:
+            format = "csv" if path.endswith(".csv") else "jsonl"
+        if format not in ("csv", "jsonl"):
+            raise ValueError(f"Unknown format: {format}")
+        self.path, self.format, self.callback = path, format, callback
+
+    def write(self, metrics):
+        """Appends the record of the specified case metrics to the log."""
+        record = metrics.to_dict() if isinstance(metrics, CaseMetrics) else dict(metrics)
+        if self.format == "jsonl":
+            with open(self.path, "a") as file:
+                file.write(json.dumps(record) + "\n")
+        else:
+            exists = os.path.exists(self.path) and os.path.getsize(self.path) > 0
+            if exists:
+                with open(self.path, newline="") as file:
+                    fieldnames = next(csv.reader(file))
+            else:
+                fieldnames = list(record.keys())
+            with open(self.path, "a", newline="") as file:
+                writer = csv.DictWriter(file, fieldnames=fieldnames, extrasaction="ignore")
+                if not exists:
+                    writer.writeheader()
+                writer.writerow(record)
+        if self.callback is not None:
+            self.callback(record)
+
+
+if __name__ == "__main__":
+    from comsol import Parameters, init_model
+    from superposition import eval_response
+    from budapest import make_geologies
+    import mock_mph
+    import tempfile
+    # Collects the metrics of mock COMSOL models of the Budapest geologies into a CSV file.
+    log = MetricsLog(os.path.join(tempfile.mkdtemp(), "metrics.csv"), callback=lambda record: print(record))
+    client = mock_mph.start()
+    for geology in make_geologies(v_groundwater="predefined"):
+        for borehole_spacing in [20, 100]:
+            params = Parameters(L_borehole=200, D_borehole=0.150, borehole_spacing=borehole_spacing, num_years=50, E_annual=0)
+            metrics = CaseMetrics(geology.name, verbose=False)
+            eval_response(init_model(client, params, geology, metrics), metrics=metrics)
+            log.write(metrics)
+            client.clear()
+    with open(log.path) as file:
+        print(file.read())
@@ -0,0 +1,194 @@
+from utils import num_to_str
+import numpy as np
+import re
+
+
+SECTIONS = {"param": "parameters", "func": "functions", "geom": "geometry", "selection": "selections", "mesh": "mesh", "physics": "physics", "cpl": "variables", "variable": "variables", "study": "solver", "sol": "solver"}
+
+
+def _parse_number(value):
+    """Parses the number of a COMSOL style quantity such as "200[m]"."""
+    return float(str(value).split("[")[0])
+
+
+class Recorder:
+    """This class records the Java calls made on a mock model and counts them per model section."""
+
+    def __init__(self):
+        self.calls = []
+        self.counts = {}
+        self.params = {}
+        self.tlist = None
+        self.elemcounts = []
+
+    def record(self, path):
+        self.calls.append(path)
+        section = "model"
+        for name, args in path:
+            if name in SECTIONS:
+                section = SECTIONS[name]
+                break
+        self.counts[section] = self.counts.get(section, 0) + 1
+        name, args = path[-1]
+        if name == "set" and len(args) == 2:
+            if path[0][0] == "param":
+                self.params[args[0]] = args[1]
+            elif args[0] == "tlist":
+                self.tlist = args[1]
+            elif args[0] == "elemcount":
+                self.elemcounts.append(int(args[1]))
+
+    def num_elements(self):
+        """Returns a synthetic element count that grows with the number of swept elements like a real mesh."""
+        num_blocks = sum(1 for path in self.calls if path[-1][0] == "create" and path[-1][1][1:] == ("Block",))
+        return 2000 * (sum(self.elemcounts) + 20 * num_blocks)
+
+    def num_dofs(self):
+        """Returns a synthetic number of degrees of freedom for linear elements."""
+        return self.num_elements() // 5
+
+    def tree(self):
+        """Returns the recorded calls as lines of an indented call tree."""
+        lines, previous = [], ()
+        for path in self.calls:
+            common = 0
+            while common < min(len(previous), len(path)-1) and previous[common] == path[common]:
+                common += 1
+            for depth in range(common, len(path)):
+                name, args = path[depth]
+                lines.append(f"{'  '*depth}{name}({', '.join(repr(arg) for arg in args)})")
+            previous = path
+        return lines
+
+
+class _JavaObject:
+    """This class stands in for a Java object reached through model.java."""
+
+    def __init__(self, recorder, path=()):
+        self._recorder, self._path = recorder, path
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return _JavaMethod(self._recorder, self._path, name)
+
+
+class _JavaMethod:
+
+    def __init__(self, recorder, path, name):
+        self._recorder, self._path, self._name = recorder, path, name
+
+    def __call__(self, *args):
+        path = self._path + ((self._name, args),)
+        self._recorder.record(path)
+        if self._name == "getNumElem":
+            return self._recorder.num_elements()
+        elif self._name == "nDofs":
+            return self._recorder.num_dofs()
+        return _JavaObject(self._recorder, path)
+
+
+class Model:
+    """This class stands in for mph.Model. It records the Java calls and returns synthetic solutions that are linear in E_annual."""
+
+    def __init__(self, name):
+        self.name = name
+        self.recorder = Recorder()
+        self.java = _JavaObject(self.recorder)
+        self.solution = None
+        self.num_solves = 0
+
+    def parameter(self, name, value=None):
+        if value is None:
+            return self.recorder.params[name]
+        self.recorder.params[name] = value
+
+    def solve(self):
+        params = self.recorder.params
+        num_years = 50
+        if self.recorder.tlist is not None:
+            num_years = float(re.findall(r"[\d.]+", self.recorder.tlist)[-1])
+        t = np.arange(int(12*num_years)+1) / 12
+        L_borehole, borehole_spacing = _parse_number(params["L_borehole"]), _parse_number(params["borehole_spacing"])
+        T_undisturbed = _parse_number(params["T_surface"]) + 0.5 * _parse_number(params["q_geothermal"]) * L_borehole / 2.5
+        T_unit = -100 / L_borehole * (1 + np.log1p(t) * 20 / borehole_spacing) * (t > 0)
+        self.solution = {"t": t, "T_ave": T_undisturbed + _parse_number(params["E_annual"]) * T_unit}
+        self.num_solves += 1
+
+    def evaluate(self, expression, unit=None):
+        if self.solution is None:
+            raise RuntimeError("The model must be solved before evaluating results.")
+        if expression == "t":
+            return self.solution["t"] if unit == "a" else self.solution["t"] * 31556952
+        elif expression == "T_ave":
+            return self.solution["T_ave"] if unit == "degC" else self.solution["T_ave"] + 273.15
+        raise ValueError(f"Unsupported expression: {expression}")
+
+    def __str__(self):
+        counts = ", ".join(f"{section}={count}" for section, count in self.recorder.counts.items())
+        return f"Model(name={self.name}, num_calls={len(self.recorder.calls)}, {counts})"
+
+
+class Client:
+    """This class stands in for mph.Client, so init_model() and eval_temp() can be run and benchmarked without a COMSOL server."""
+
+    def __init__(self, cores=None):
+        self.cores = cores
+        self.models = []
+
+    def create(self, name=None):
+        model = Model(name)
+        self.models.append(model)
+        return model
+
+    def remove(self, model):
+        self.models.remove(model)
+
+    def clear(self):
+        self.models = []
+
+
+def start(cores=None):
+    """Starts a mock client like mph.start()."""
+    return Client(cores)
+
+
+def benchmark(num_layers_list, L_borehole=200, borehole_spacing=20):
+    """Times init_model() with a mock client for geologies with the specified numbers of layers and returns the call counts per section."""
+    from comsol import Parameters, init_model
+    from geology import Geology, PorousMaterial, PorousLayer
+    import contextlib
+    import time
+    import io
+    material = PorousMaterial("Rock", k_matrix=2.0, Cp_matrix=850, rho_matrix=2500, porosity=0.1)
+    params = Parameters(L_borehole=L_borehole, D_borehole=0.150, borehole_spacing=borehole_spacing, num_years=50, E_annual=0, monthly_fractions=np.ones(12)/12)
+    client = start()
+    records = []
+    for num_layers in num_layers_list:
+        z = np.linspace(0, -1000, num_layers+1)
+        geology = Geology(f"{num_layers} Layers", T_surface=10, q_geothermal=0.08)
+        for i in range(num_layers):
+            geology.add_layer(PorousLayer(f"Layer {i+1}", material, z[i], z[i+1], velocity=1e-8))
+        tic = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            model = init_model(client, params, geology)
+        toc = time.perf_counter()
+        records.append({"num_layers": num_layers, "time": toc-tic, "num_calls": len(model.recorder.calls), **model.recorder.counts})
+        client.clear()
+    return records
+
+
+if __name__ == "__main__":
+    from comsol import Parameters, init_model, eval_temp
+    from superposition import eval_response
+    from budapest import make_geologies
+    # Builds and solves a mock model of a Budapest geology.
+    params = Parameters(L_borehole=200, D_borehole=0.150, borehole_spacing=20, num_years=50, E_annual=0)
+    model = init_model(start(), params, make_geologies(v_groundwater="predefined")[-1])
+    print(model)
+    print("\n".join(model.recorder.tree()[:12]))
+    eval_temp(model, 10)
+    print(eval_response(model))
+    # Shows how the setup overhead scales with the number of layers.
+    for record in benchmark([1, 2, 4, 8, 16, 32]):
+        print(", ".join(f"{key}={num_to_str(value)}" for key, value in record.items()))
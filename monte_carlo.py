@@ -0,0 +1,166 @@
+from concurrent.futures import ProcessPoolExecutor
+from superposition import eval_response
+from geology import GeologyArrays, PorousLayer, truncation_depth
+from metrics import CaseMetrics
+from utils import num_to_str
+import scipy.stats.qmc
+import scipy.stats
+import numpy as np
+import contextlib
+import functools
+import native
+import io
+
+
+# Multiplicative factors applied to the base values of each layer. The velocity factor is applied only to layers that
+# have groundwater flow. Its standard deviation of 1.0 in log space is a factor of e, so an order of magnitude either
+# way is about 2.3 standard deviations and covers 98 % of the samples.
+DEFAULT_UNCERTAINTIES = {
+    "k_matrix": scipy.stats.lognorm(s=0.15),
+    "porosity": scipy.stats.uniform(loc=0.5, scale=1.0),
+    "velocity": scipy.stats.lognorm(s=1.0),
+}
+
+
+class GeologySampler:
+    """This class draws perturbed copies of a geology with porous layers as GeologyArrays.
+
+    Each uncertain property of each layer is one dimension of a Latin hypercube or a scrambled Sobol sequence, which is
+    mapped to a multiplicative factor through the inverse CDF of the property's distribution."""
+
+    def __init__(self, geology, uncertainties=None, method="sobol", seed=None):
+        if not all(type(layer) is PorousLayer for layer in geology.layers):
+            raise TypeError("All layers must be porous layers.")
+        self.geology = geology
+        self.uncertainties = DEFAULT_UNCERTAINTIES if uncertainties is None else uncertainties
+        self.names = list(self.uncertainties.keys())
+        dimension = len(self.names) * len(geology.layers)
+        if method == "sobol":
+            self.sampler = scipy.stats.qmc.Sobol(dimension, scramble=True, seed=seed)
+        elif method == "lhs":
+            self.sampler = scipy.stats.qmc.LatinHypercube(dimension, seed=seed)
+        else:
+            raise ValueError(f"Unknown sampling method: {method}")
+        materials = [layer.material for layer in geology.layers]
+        self.base = {name: np.array([getattr(material, name) for material in materials]) for name in ["k_matrix", "Cp_matrix", "rho_matrix", "porosity", "k_fluid", "Cp_fluid", "rho_fluid"]}
+        self.base["velocity"] = np.array([layer.velocity for layer in geology.layers])
+        self.z_from = np.array([layer.z_from for layer in geology.layers])
+        self.z_to = np.array([layer.z_to for layer in geology.layers])
+
+    def factors(self, num_samples):
+        """Returns the next factors as a dict of arrays with one row per sample and one column per layer."""
+        u = self.sampler.random(num_samples).reshape((num_samples, len(self.names), len(self.geology.layers)))
+        return {name: self.uncertainties[name].ppf(u[:, i, :]) for i, name in enumerate(self.names)}
+
+    def sample(self, num_samples):
+        """Returns the next perturbed geologies."""
+        factors = self.factors(num_samples)
+        values = {name: self.base[name] * factors.get(name, 1) for name in ["k_matrix", "porosity", "velocity"]}
+        porosity = np.clip(values["porosity"], 0, 0.99)
+        k = (1 - porosity) * values["k_matrix"] + porosity * self.base["k_fluid"]
+        rho = (1 - porosity) * self.base["rho_matrix"] + porosity * self.base["rho_fluid"]
+        C = (1 - porosity) * self.base["rho_matrix"] * self.base["Cp_matrix"] + porosity * self.base["rho_fluid"] * self.base["Cp_fluid"]
+        return [GeologyArrays(f"{self.geology.name} #{i+1}", self.geology.T_surface, self.geology.q_geothermal, self.z_from, self.z_to, k[i], C[i]/rho[i], rho[i], porosity[i], values["velocity"][i], self.base["Cp_fluid"], self.base["rho_fluid"]) for i in range(num_samples)]
+
+
+def eval_E_max(params, geology, T_min=0.0, truncation=3, radius_factor=1.0):
+    """Evaluates E_max of a geology with the fastest native model that can simulate it.
+
+    Without groundwater flow this is the axisymmetric model with the specified radius factor, which should come from
+    native.calibrate_radius(). With the default factor of one, E_max is biased by the difference of the round cell from
+    the square one, which grows as the boreholes interact more."""
+    axisymmetric = not geology.has_groundwater_flow
+    with contextlib.redirect_stdout(io.StringIO()):
+        model = native.init_model(params, geology, CaseMetrics(verbose=False), truncation=truncation, axisymmetric=axisymmetric, **({"radius_factor": radius_factor} if axisymmetric else {}))
+        return eval_response(model).E_max(T_min)
+
+
+class QuantileSummary:
+    """This class accumulates samples and tracks quantiles with distribution-free confidence intervals.
+
+    The confidence interval of the p quantile of n samples is spanned by the order statistics whose ranks are
+    n*p -/+ z*sqrt(n*p*(1-p)), so the interval narrows as the samples accumulate regardless of the distribution."""
+
+    def __init__(self, quantiles=(0.1, 0.5, 0.9), confidence=0.95):
+        self.quantiles, self.confidence = quantiles, confidence
+        self.batches = []
+
+    def add(self, values):
+        self.batches.append(np.ravel(values))
+
+    @property
+    def values(self):
+        # The batches are concatenated only when the samples are needed and then kept as a single batch.
+        if len(self.batches) != 1:
+            self.batches = [np.concatenate(self.batches) if len(self.batches) > 0 else np.zeros(0)]
+        return self.batches[0]
+
+    def __len__(self):
+        return sum(len(batch) for batch in self.batches)
+
+    def confidence_interval(self, p):
+        """Returns the confidence interval of the p quantile."""
+        n = len(self.values)
+        z = scipy.stats.norm.ppf(0.5 + 0.5 * self.confidence)
+        sorted_values = np.sort(self.values)
+        lower = int(np.clip(np.floor(n*p - z*np.sqrt(n*p*(1-p))), 0, n-1))
+        upper = int(np.clip(np.ceil(n*p + z*np.sqrt(n*p*(1-p))), 0, n-1))
+        return sorted_values[lower], sorted_values[upper]
+
+    def summary(self):
+        """Returns the number of samples, the mean, the standard deviation, the quantiles and the relative half widths of their confidence intervals."""
+        summary = {"num_samples": len(self.values), "mean": np.mean(self.values), "std": np.std(self.values, ddof=1) if len(self.values) > 1 else np.nan}
+        P50 = np.quantile(self.values, 0.5)
+        for p in self.quantiles:
+            lower, upper = self.confidence_interval(p)
+            summary[f"P{round(100*p)}"] = np.quantile(self.values, p)
+            summary[f"P{round(100*p)}_error"] = 0.5 * (upper - lower) / abs(P50)
+        return summary
+
+    def converged(self, rtol):
+        """Returns True if the confidence intervals of all quantiles are narrower than rtol times the median."""
+        summary = self.summary()
+        return all(summary[f"P{round(100*p)}_error"] <= rtol for p in self.quantiles)
+
+
+def run_monte_carlo(params, geology, uncertainties=None, method="sobol", seed=None, T_min=0.0, batch_size=32, min_samples=64, max_samples=1024, rtol=0.01, max_workers=None, evaluate=None, radius_factor=None, truncation=3):
+    """Runs Monte Carlo simulations of E_max for the specified geology in batches and yields the summary after each batch.
+
+    Sampling stops when the confidence intervals of P10, P50 and P90 are narrower than rtol times P50, but not before
+    min_samples have been run, or when max_samples is reached. The batch size should be a power of two for Sobol.
+    Without groundwater flow the samples are evaluated with the axisymmetric model, whose radius factor is calibrated
+    once against the 3D model of the base geology unless it is specified."""
+
+    sampler = GeologySampler(geology, uncertainties, method, seed)
+    if evaluate is None:
+        if radius_factor is None and not geology.has_groundwater_flow:
+            print("Calibrating the axisymmetric model...")
+            with contextlib.redirect_stdout(io.StringIO()):
+                radius_factor = native.calibrate_radius(params, geology.truncate(truncation_depth(geology, params.L_borehole, params.num_years, truncation)), T_min=T_min)
+            print(f"radius_factor={num_to_str(radius_factor)}")
+        evaluate = functools.partial(eval_E_max, T_min=T_min, truncation=truncation, radius_factor=1.0 if radius_factor is None else radius_factor)
+    statistics = QuantileSummary()
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        while len(statistics) < max_samples:
+            geologies = sampler.sample(batch_size)
+            statistics.add(list(executor.map(evaluate, [params]*len(geologies), geologies)))
+            summary = statistics.summary()
+            summary["converged"] = summary["num_samples"] >= min_samples and statistics.converged(rtol)
+            yield summary
+            if summary["converged"]:
+                break
+
+
+if __name__ == "__main__":
+    from budapest import make_geologies
+    from comsol import Parameters
+    import time
+    monthly_fractions = [0.194717, 0.17216, 0.128944, 0.075402, 0.024336, 0, 0, 0, 0.025227, 0.076465, 0.129925, 0.172824]
+    params = Parameters(L_borehole=200, D_borehole=0.150, borehole_spacing=20, num_years=50, E_annual=0, monthly_fractions=monthly_fractions)
+    geology = make_geologies(v_groundwater=0)[-1]
+    # Streams the summary of E_max of a Budapest site without groundwater flow until P10, P50 and P90 are known within 2 %.
+    tic = time.time()
+    for summary in run_monte_carlo(params, geology, seed=1, rtol=0.02):
+        print(", ".join(f"{key}={num_to_str(value)}" for key, value in summary.items()))
+    print(f"Done in {time.time()-tic:.1f}s.")
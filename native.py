@@ -0,0 +1,455 @@
+"""Native NumPy/SciPy finite volume models of the infinite borehole field unit cell.
+
+With the default grids, E_max is 0.8-2.0 % higher than in the COMSOL results of results_without_groundwater_flow.xlsx
+and results_with_groundwater_flow.xlsx, and a case with a borehole spacing of 100 m takes 96-319 s. Finer grids from a
+mesh policy reduce the difference at the cost of time."""
+
+from utils import num_to_str
+from geology import as_arrays, truncation_depth
+from metrics import CaseMetrics
+from mesh import get_policy
+import scipy.sparse.linalg
+import scipy.sparse
+import numpy as np
+
+
+SECONDS_PER_YEAR = 31556952 # The length of COMSOL's year unit "a" [s]
+
+BACKEND_VERSION = "native-1" # Change this when the model changes so that cached results are invalidated.
+
+AXISYMMETRIC_VERSION = "native-axisymmetric-1"
+
+
+def _parse_quantity(value):
+    """Parses a COMSOL style quantity such as "30[MWh]" to a number."""
+    if isinstance(value, str):
+        value = value.split("[")[0]
+    return float(value)
+
+
+def _graded_nodes(length, h_first, growth, h_max):
+    """Returns node coordinates from zero to the specified length with geometrically growing spacing."""
+    nodes = [0.0]
+    h = h_first
+    while nodes[-1] + h < length:
+        nodes.append(nodes[-1] + h)
+        h = min(growth * h, h_max)
+    if length - nodes[-1] < 0.5 * (nodes[-1] - nodes[-2] if len(nodes) > 1 else length):
+        nodes[-1] = length
+    else:
+        nodes.append(length)
+    return np.array(nodes)
+
+
+def _control_widths(nodes, periodic=False):
+    """Returns the widths of the control volumes surrounding the specified nodes."""
+    h = np.diff(nodes)
+    widths = np.zeros(len(nodes))
+    widths[:-1] += 0.5 * h
+    widths[1:] += 0.5 * h
+    if periodic:
+        # The first and the last node coincide, so only the first one is kept.
+        widths[0] += widths[-1]
+        widths = widths[:-1]
+    return widths
+
+
+def _power_law(peclet):
+    """Evaluates Patankar's power-law scheme A(|P|) used for weighting conduction against advection."""
+    return np.maximum(0, (1 - 0.1 * np.abs(peclet))**5)
+
+
+class Model:
+    """This class is a pure NumPy/SciPy replacement for the COMSOL model of the infinite borehole field unit cell.
+
+    The unit cell is discretized with vertex-centered finite volumes on a tensor-product grid and the borehole is a line
+    sink whose wall temperature is recovered with Peaceman's equivalent radius. The parameter(), solve() and evaluate()
+    methods mimic an mph model, so the model can be passed to comsol.eval_temp() unchanged. The time steps and the
+    factorizations are kept between solves."""
+
+    def __init__(self, params, geology, h_borehole=None, growth=1.2, dz_max=5.0, substeps=4, tlist=None):
+        self.params, self.geology = params, geology
+        self.layers = as_arrays(geology)
+        self.E_annual = params.E_annual
+        self.substeps = substeps
+        self.tlist = None if tlist is None else np.asarray(tlist, dtype=float)
+        self.solution = None
+        self._schedule = None
+        self._factorizations = {}
+        self._build_grid(h_borehole if h_borehole is not None else 4 * params.D_borehole, growth, dz_max)
+        self._assemble()
+
+    @property
+    def num_dofs(self):
+        """The number of unknown temperatures."""
+        return self.capacity.size
+
+    def _build_grid(self, h_borehole, growth, dz_max):
+        params, geology = self.params, self.geology
+
+        # Lateral grid: a quarter cell without groundwater flow and a half cell that is periodic in the x direction
+        # with groundwater flow. The borehole is located at the origin in both cases.
+        half = _graded_nodes(0.5 * params.borehole_spacing, h_borehole, growth, 0.1 * params.borehole_spacing)
+        if geology.has_groundwater_flow:
+            self.x = np.concatenate((-half[::-1], half[1:]))
+            self.x_widths = _control_widths(self.x, periodic=True)
+            self.x_borehole = len(half) - 1
+            self.num_borehole_parts = 2
+        else:
+            self.x = half
+            self.x_widths = _control_widths(self.x)
+            self.x_borehole = 0
+            self.num_borehole_parts = 4
+        self.y = half
+        self.y_widths = _control_widths(self.y)
+
+        self._build_vertical_grid(growth, dz_max)
+
+    def _build_vertical_grid(self, growth, dz_max):
+        params, geology = self.params, self.geology
+
+        # Vertical grid: the nodes include the ground surface, the layer interfaces and the bottom of the borehole.
+        # The element size is at most dz_max along the borehole and grows geometrically below it.
+        interfaces = sorted(set([0.0, -float(params.L_borehole)] + [float(z_to) for z_to in self.layers.z_to if z_to > -geology.thickness] + [-float(geology.thickness)]), reverse=True)
+        z = [0.0]
+        for z_from, z_to in zip(interfaces[:-1], interfaces[1:]):
+            if z_from > -params.L_borehole:
+                num_elem = max(2, int(np.ceil((z_from-z_to)/dz_max)))
+                z.extend(np.linspace(z_from, z_to, num_elem+1)[1:])
+            else:
+                nodes = _graded_nodes(z_from-z_to, dz_max, growth, 20*dz_max)
+                z.extend(z_from-nodes[1:])
+        self.z = np.array(z)
+
+    def _assemble(self):
+        params, geology = self.params, self.geology
+
+        nx, ny, nz = len(self.x_widths), len(self.y_widths), len(self.z)
+        dz = -np.diff(self.z)
+
+        k_elem, C_elem, F_elem = self._element_properties()
+
+        kh = self._half_sum(k_elem)
+        Ch = self._half_sum(C_elem)
+        Fh = self._half_sum(F_elem)
+        hz = self._half_sum(np.ones(nz-1))
+
+        index = np.arange(nx*ny*nz).reshape((nx, ny, nz))
+
+        rows, cols, vals = [], [], []
+
+        def couple(i, j, a_ij, a_ji):
+            """Adds the flux a_ij*T_i - a_ji*T_j from nodes i to nodes j."""
+            rows.extend([i, i, j, j])
+            cols.extend([i, j, j, i])
+            vals.extend([a_ij, -a_ji, a_ji, -a_ij])
+
+        wx, wy = self.x_widths, self.y_widths
+
+        # Lateral coupling in the x direction including advection by groundwater flow.
+        dx = np.diff(self.x)
+        num_x_faces = nx if geology.has_groundwater_flow else nx - 1
+        for i in range(num_x_faces):
+            D = (wy[:, None] * kh[None, :] / dx[i]).ravel()
+            F = (wy[:, None] * Fh[None, :]).ravel()
+            P = np.divide(F, D, out=np.zeros_like(F), where=D>0)
+            a = D * _power_law(P)
+            couple(index[i].ravel(), index[(i+1)%nx].ravel(), a + np.maximum(F, 0), a + np.maximum(-F, 0))
+
+        # Lateral coupling in the y direction.
+        dy = np.diff(self.y)
+        for j in range(ny-1):
+            D = (wx[:, None] * kh[None, :] / dy[j]).ravel()
+            couple(index[:, j, :].ravel(), index[:, j+1, :].ravel(), D, D)
+
+        # Vertical coupling.
+        A_xy = (wx[:, None] * wy[None, :]).ravel()
+        for k in range(nz-1):
+            D = A_xy * k_elem[k] / dz[k]
+            couple(index[:, :, k].ravel(), index[:, :, k+1].ravel(), D, D)
+
+        A = scipy.sparse.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))), shape=(nx*ny*nz, nx*ny*nz))
+
+        # The ground surface nodes have a fixed temperature and are eliminated from the system.
+        fixed = index[:, :, 0].ravel()
+        free = index[:, :, 1:].ravel()
+        reduced = np.arange(nx*ny*(nz-1)).reshape((nx, ny, nz-1))
+
+        self.A = A[free][:, free].tocsc()
+        self.capacity = (A_xy[:, None] * Ch[None, 1:]).ravel()
+
+        self.b_constant = -A[free][:, fixed] @ np.full(len(fixed), geology.T_surface)
+        self.b_constant[reduced[:, :, -1].ravel()] += A_xy * geology.q_geothermal
+
+        self.wall_weights, source_weights = self._borehole_weights()
+
+        self.axis_nodes = reduced[self.x_borehole, 0, :]
+        self.b_extraction = np.zeros(self.capacity.size)
+        self.b_extraction[self.axis_nodes] = -source_weights / self.num_borehole_parts
+
+        # Peaceman's equivalent radius relates the nodal temperature on the axis to the borehole wall temperature.
+        dx_borehole = self.x[self.x_borehole+1] - self.x[self.x_borehole]
+        dy_borehole = self.y[1] - self.y[0]
+        r_equivalent = 0.14 * np.sqrt(dx_borehole**2 + dy_borehole**2)
+        self.wall_resistance = np.log(r_equivalent / (0.5 * params.D_borehole)) / (2 * np.pi * (kh / hz) * params.L_borehole)
+
+        self.T_initial = np.tile(self._geotherm()[1:], nx*ny)
+
+    def _element_properties(self):
+        """Returns the conductivity, the volumetric heat capacity and the groundwater heat flux of each vertical element.
+
+        The properties are taken from the layer enclosing the element midpoint."""
+        layers = self.layers
+        i = layers.layer_index(0.5 * (self.z[:-1] + self.z[1:]))
+        return layers.k[i], layers.rho[i] * layers.Cp[i], layers.rho_fluid[i] * layers.Cp_fluid[i] * layers.velocity[i]
+
+    def _half_sum(self, values):
+        """Returns thickness weighted sums of element values over the upper and lower halves of each vertical control volume."""
+        dz = -np.diff(self.z)
+        sums = np.zeros(len(self.z))
+        sums[:-1] += 0.5 * values * dz
+        sums[1:] += 0.5 * values * dz
+        return sums
+
+    def _borehole_weights(self):
+        """Returns the weights of the nodes in the mean borehole wall temperature and in the heat extraction.
+
+        The heat extraction is distributed evenly along the borehole. The share of the ground surface node is moved to
+        the node below it so that no extracted heat is lost to the fixed temperature boundary."""
+        dz = -np.diff(self.z)
+        upper = np.minimum(self.z + 0.5 * np.concatenate(([0], dz)), 0)
+        lower = np.maximum(self.z - 0.5 * np.concatenate((dz, [0])), -self.params.L_borehole)
+        overlap = np.maximum(upper - lower, 0)
+        source_weights = overlap[1:].copy()
+        source_weights[0] += overlap[0]
+        return overlap / np.sum(overlap), source_weights / np.sum(source_weights)
+
+    def _geotherm(self):
+        """Returns the undisturbed geotherm at the vertical nodes, which is the initial and the steady state of the model."""
+        return self.layers.T_initial(self.z)
+
+    def parameter(self, name, value=None):
+        """Sets or returns the value of a model parameter like mph.Model.parameter()."""
+        if name != "E_annual":
+            raise ValueError(f"Unknown parameter: {name}")
+        if value is None:
+            return f"{num_to_str(self.E_annual)}[MWh]"
+        self.E_annual = _parse_quantity(value)
+        self.solution = None
+
+    def times(self):
+        """Returns the output times of the simulation in seconds."""
+        if self.tlist is not None:
+            return self.tlist
+        return np.arange(12*self.params.num_years+1) * SECONDS_PER_YEAR / 12
+
+    def extraction_rates(self, t_from, t_to, E_annual=None):
+        """Returns the mean heat extraction rate in watts for each of the specified time intervals."""
+        E_annual = (self.E_annual if E_annual is None else E_annual) * 3.6e9 # [J]
+        if self.params.monthly_fractions is None:
+            return np.full(len(t_from), E_annual / SECONDS_PER_YEAR)
+        month = np.floor(12 * np.mod(0.5 * (t_from + t_to), SECONDS_PER_YEAR) / SECONDS_PER_YEAR).astype(int)
+        return E_annual * np.asarray(self.params.monthly_fractions)[month] / (SECONDS_PER_YEAR / 12)
+
+    def _factorize(self, dt, scale):
+        key = (round(dt, 6), round(scale, 9))
+        if key not in self._factorizations:
+            matrix = scipy.sparse.diags(scale * self.capacity / dt) + self.A
+            self._factorizations[key] = scipy.sparse.linalg.splu(matrix.tocsc())
+        return self._factorizations[key]
+
+    def wall_temperature(self, T, Q):
+        """Returns the mean borehole wall temperature for the specified nodal temperatures and extraction rate."""
+        T_axis = np.concatenate(([self.geology.T_surface], T[self.axis_nodes]))
+        T_wall = T_axis - Q * self.wall_resistance
+        T_wall[0] = self.geology.T_surface
+        return np.sum(self.wall_weights * T_wall)
+
+    def time_steps(self):
+        """Returns the output times, the time steps and the extraction rates per MWh of annual heat extraction, which are computed once per model."""
+        if self._schedule is None:
+            t_out = self.times()
+            t = np.interp(np.arange(self.substeps*(len(t_out)-1)+1)/self.substeps, np.arange(len(t_out)), t_out)
+            self._schedule = (t_out, t, self.extraction_rates(t[:-1], t[1:], E_annual=1))
+        return self._schedule
+
+    def solve(self):
+        """Runs the transient simulation using the variable step BDF2 method with cached factorizations."""
+        t_out, t, unit_rates = self.time_steps()
+        Q = self.E_annual * unit_rates
+        T_previous, T = None, self.T_initial.copy()
+        T_ave = np.zeros(len(t_out))
+        T_ave[0] = self.wall_temperature(T, 0)
+        for n in range(len(t)-1):
+            dt = t[n+1] - t[n]
+            if T_previous is None:
+                # The first step is taken with the backward Euler method.
+                rhs = self.capacity / dt * T
+                lu = self._factorize(dt, 1)
+            else:
+                omega = dt / (t[n] - t[n-1])
+                rhs = self.capacity / dt * ((1 + omega) * T - omega**2 / (1 + omega) * T_previous)
+                lu = self._factorize(dt, (1 + 2 * omega) / (1 + omega))
+            T_previous, T = T, lu.solve(rhs + self.b_constant + Q[n] * self.b_extraction)
+            if (n + 1) % self.substeps == 0:
+                T_ave[(n+1)//self.substeps] = self.wall_temperature(T, Q[n])
+        self.solution = {"t": t_out, "T_ave": T_ave}
+
+    def evaluate(self, expression, unit=None):
+        """Evaluates a quantity of the solution like mph.Model.evaluate()."""
+        if self.solution is None:
+            raise RuntimeError("The model must be solved before evaluating results.")
+        if expression == "t":
+            if unit in (None, "s"):
+                return self.solution["t"]
+            elif unit == "a":
+                return self.solution["t"] / SECONDS_PER_YEAR
+            raise ValueError(f"Unsupported unit: {unit}")
+        elif expression == "T_ave":
+            if unit in (None, "K"):
+                return self.solution["T_ave"] + 273.15
+            elif unit == "degC":
+                return self.solution["T_ave"]
+            raise ValueError(f"Unsupported unit: {unit}")
+        raise ValueError(f"Unsupported expression: {expression}")
+
+
+class AxisymmetricModel(Model):
+    """This class is a reduced-order model of the unit cell for geologies without groundwater flow.
+
+    The square unit cell is replaced by a cylinder of equal area, whose radius is B/sqrt(pi) times radius_factor, with
+    an insulated outer boundary. The borehole wall is resolved by the first radial node, so no equivalent radius is
+    needed. The model is solved on an r-z grid with the same vertical grid and outputs as the 3D model."""
+
+    def __init__(self, params, geology, h_wall=None, growth=1.2, dz_max=5.0, substeps=4, tlist=None, radius_factor=1.0):
+        if geology.has_groundwater_flow:
+            raise ValueError("The axisymmetric model can not simulate groundwater flow.")
+        self.radius_factor = radius_factor
+        super().__init__(params, geology, h_wall if h_wall is not None else 0.25 * params.D_borehole, growth, dz_max, substeps, tlist)
+
+    def _build_grid(self, h_wall, growth, dz_max):
+        params = self.params
+        r_borehole = 0.5 * params.D_borehole
+        r_outer = self.radius_factor * params.borehole_spacing / np.sqrt(np.pi)
+        self.r = r_borehole + _graded_nodes(r_outer-r_borehole, h_wall, growth, 0.1*params.borehole_spacing)
+        # The control volume faces are at the geometric means of the nodes, which suits the logarithmic radial profile.
+        faces = np.concatenate(([r_borehole], np.sqrt(self.r[:-1]*self.r[1:]), [r_outer]))
+        self.r_areas = np.pi * np.diff(faces**2)
+        self._build_vertical_grid(growth, dz_max)
+
+    def _assemble(self):
+        geology = self.geology
+
+        nr, nz = len(self.r), len(self.z)
+        dz = -np.diff(self.z)
+
+        k_elem, C_elem, _ = self._element_properties()
+
+        kh = self._half_sum(k_elem)
+        Ch = self._half_sum(C_elem)
+
+        index = np.arange(nr*nz).reshape((nr, nz))
+
+        rows, cols, vals = [], [], []
+
+        def couple(i, j, a):
+            rows.extend([i, i, j, j])
+            cols.extend([i, j, j, i])
+            vals.extend([a, -a, a, -a])
+
+        # Radial coupling uses the exact conductance of a cylindrical shell.
+        for i in range(nr-1):
+            couple(index[i], index[i+1], 2 * np.pi * kh / np.log(self.r[i+1]/self.r[i]))
+
+        # Vertical coupling.
+        for k in range(nz-1):
+            couple(index[:, k], index[:, k+1], self.r_areas * k_elem[k] / dz[k])
+
+        A = scipy.sparse.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))), shape=(nr*nz, nr*nz))
+
+        # The ground surface nodes have a fixed temperature and are eliminated from the system.
+        fixed = index[:, 0]
+        free = index[:, 1:].ravel()
+        reduced = np.arange(nr*(nz-1)).reshape((nr, nz-1))
+
+        self.A = A[free][:, free].tocsc()
+        self.capacity = (self.r_areas[:, None] * Ch[None, 1:]).ravel()
+
+        self.b_constant = -A[free][:, fixed] @ np.full(len(fixed), geology.T_surface)
+        self.b_constant[reduced[:, -1]] += self.r_areas * geology.q_geothermal
+
+        # The heat is extracted through the borehole wall, whose temperature is the temperature of the wall nodes.
+        self.wall_weights, source_weights = self._borehole_weights()
+        self.axis_nodes = reduced[0, :]
+        self.b_extraction = np.zeros(self.capacity.size)
+        self.b_extraction[self.axis_nodes] = -source_weights
+        self.wall_resistance = 0.0
+
+        self.T_initial = np.tile(self._geotherm()[1:], nr)
+
+
+def calibrate_radius(params, geology, E_target=None, T_min=0.0):
+    """Returns the radius factor with which the axisymmetric model gives the specified E_max of a 3D quarter cell model.
+
+    E_target is typically a COMSOL result. If it is not specified, the native 3D model is solved for it."""
+    import scipy.optimize
+    from superposition import eval_response
+    if E_target is None:
+        E_target = eval_response(Model(params, geology)).E_max(T_min)
+    def squared_error(radius_factor):
+        return (eval_response(AxisymmetricModel(params, geology, radius_factor=radius_factor)).E_max(T_min) - E_target)**2
+    # The factor matters only when the boreholes interact, so the error is minimized rather than solved for zero.
+    return scipy.optimize.minimize_scalar(squared_error, bounds=(0.8, 1.25), method="bounded", options={"xatol": 1e-3}).x
+
+
+def init_model(params, geology, metrics=None, mesh=None, truncation=None, axisymmetric=False, **kwargs):
+    """Constructs a new native model having the specified parameters for simulating heat extraction from the specified geology.
+
+    The grid resolution follows the specified mesh policy unless it is overridden by keyword arguments. If truncation
+    is specified, the domain ends that many diffusion lengths below the borehole instead of at the bottom of the geology.
+    With axisymmetric=True the reduced-order model is constructed, which requires a geology without groundwater flow."""
+
+    if metrics is None:
+        metrics = CaseMetrics(geology.name)
+
+    if truncation is not None:
+        geology = geology.truncate(truncation_depth(geology, params.L_borehole, params.num_years, truncation))
+
+    if mesh is not None:
+        mesh_kwargs = get_policy(mesh).native_kwargs(params)
+        if axisymmetric:
+            # The borehole wall is resolved, so the element size around the line sink does not apply.
+            del mesh_kwargs["h_borehole"]
+        kwargs = {**mesh_kwargs, **kwargs}
+
+    if axisymmetric:
+        metrics.start("model", "Creating a new axisymmetric model...")
+        model = AxisymmetricModel(params, geology, **kwargs)
+    else:
+        metrics.start("model", "Creating a new native model...")
+        model = Model(params, geology, **kwargs)
+
+    metrics.stop()
+
+    metrics.record(num_dofs=model.num_dofs)
+
+    if metrics.verbose:
+        print(f"Number of degrees of freedom: {model.num_dofs:,}")
+
+    return model
+
+
+if __name__ == "__main__":
+    from comsol import Parameters, eval_temp
+    from budapest import make_geologies
+    # Creates and prints parameters.
+    print("Parameters", 50*"=")
+    params = Parameters(L_borehole=200, D_borehole=0.150, borehole_spacing=20, E_annual=0, num_years=50, monthly_fractions=[0.194717, 0.17216, 0.128944, 0.075402, 0.024336, 0, 0, 0, 0.025227, 0.076465, 0.129925, 0.172824])
+    print(params)
+    # Creates and prints geology.
+    geology = make_geologies(v_groundwater=0)[-1]
+    print(geology)
+    # Evaluates the coldest mean borehole wall temperature for a few heat extraction rates.
+    model = init_model(params, geology)
+    for E_annual in [10, 20, 30]:
+        eval_temp(model, E_annual)
@@ -0,0 +1,155 @@
+from geology import PorousMaterial, PorousLayer, Geology
+import pandas as pd
+import numpy as np
+import math
+import os
+
+
+PROPERTIES = ["k_matrix", "Cp_matrix", "rho_matrix", "porosity", "velocity"]
+
+
+def make_geology(name, T_surface, q_geothermal, units, z_to, k_matrix, Cp_matrix, rho_matrix, porosity, velocity):
+    """Builds a geology from the units of a stratigraphic column given from the top down by the depths of their bases and their properties.
+
+    Units of zero thickness, which are common where a unit pinches out in a gridded model, are left out."""
+    geology = Geology(str(name), T_surface=float(T_surface), q_geothermal=float(q_geothermal))
+    z_from = 0.0
+    for i in range(len(units)):
+        if z_to[i] < z_from:
+            material = PorousMaterial(str(units[i]), k_matrix=float(k_matrix[i]), Cp_matrix=float(Cp_matrix[i]), rho_matrix=float(rho_matrix[i]), porosity=float(porosity[i]))
+            geology.add_layer(PorousLayer(f"{units[i]} Layer", material, z_from=z_from, z_to=float(z_to[i]), velocity=float(velocity[i])))
+            z_from = float(z_to[i])
+    return geology
+
+
+class InvalidColumn:
+    """This class stands in for a stratigraphic column that does not make a valid geology, so that the readers can report it and go on."""
+
+    def __init__(self, name, error):
+        self.name, self.error = str(name), str(error)
+
+    def __str__(self):
+        return f"InvalidColumn(name={self.name}, error={self.error})"
+
+
+def _make_column(x, y, name, *args):
+    """Returns (x, y, geology) or (x, y, InvalidColumn) if the data of the column is invalid."""
+    try:
+        return x, y, make_geology(name, *args)
+    except (ValueError, TypeError) as error:
+        print(f"Invalid column {name} at x={x}, y={y}: {error}")
+        return x, y, InvalidColumn(name, error)
+
+
+def _table_column(rows):
+    first = rows[0]
+    return _make_column(first.x, first.y, first.location, first.T_surface, first.q_geothermal, [row.unit for row in rows], [row.z_to for row in rows], *[[getattr(row, name) for row in rows] for name in PROPERTIES])
+
+
+def read_table(file_name, chunk_size=10000):
+    """Yields (x, y, geology) for each stratigraphic column of a CSV file having one row per layer.
+
+    The file has the columns location, x, y, T_surface, q_geothermal, unit, z_to, k_matrix, Cp_matrix and rho_matrix, and
+    optionally porosity and velocity, which default to zero. The rows of a location must be adjacent and ordered from
+    the top down. The file is read in chunks, so only one chunk and one column are held in memory at a time."""
+    rows = []
+    for chunk in pd.read_csv(file_name, chunksize=chunk_size):
+        for name in ("porosity", "velocity"):
+            if name not in chunk:
+                chunk[name] = 0.0
+        for row in chunk.itertuples(index=False):
+            if len(rows) > 0 and row.location != rows[0].location:
+                yield _table_column(rows)
+                rows = []
+            rows.append(row)
+    if len(rows) > 0:
+        yield _table_column(rows)
+
+
+def read_grid(directory):
+    """Yields (x, y, geology) for each cell of a gridded stratigraphic model stored as NumPy files in a directory.
+
+    The files x.npy and y.npy hold the cell coordinates along the axes, T_surface.npy and q_geothermal.npy grids of shape
+    (ny, nx) and z_to.npy the bases of the units from the top down in a grid of shape (num_units, ny, nx). The file
+    units.csv lists the units in the same order with the columns unit, k_matrix, Cp_matrix, rho_matrix, porosity and
+    velocity, any of which can be replaced by a grid of shape (num_units, ny, nx) in a file of the same name. The grids
+    are memory-mapped and read one cell at a time. Cells whose T_surface is NaN are skipped."""
+    load = lambda name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+    units = pd.read_csv(os.path.join(directory, "units.csv"))
+    x, y = load("x"), load("y")
+    T_surface, q_geothermal, z_to = load("T_surface"), load("q_geothermal"), load("z_to")
+    grids = {name: load(name) for name in PROPERTIES if os.path.exists(os.path.join(directory, f"{name}.npy"))}
+    for i in range(len(y)):
+        for j in range(len(x)):
+            if np.isnan(T_surface[i, j]):
+                continue
+            properties = [grids[name][:, i, j] if name in grids else units[name].to_numpy() for name in PROPERTIES]
+            yield _make_column(float(x[j]), float(y[i]), f"{j}_{i}", T_surface[i, j], q_geothermal[i, j], units["unit"].to_numpy(), z_to[:, i, j], *properties)
+
+
+def read_columns(file_name, **kwargs):
+    """Yields (x, y, geology) for each stratigraphic column of a gridded model directory or a CSV file.
+
+    A column whose data does not make a valid geology, for example a layer with groundwater flow but no porosity, is
+    reported and yielded as an InvalidColumn in place of the geology, so one bad column does not stop a long run."""
+    return read_grid(file_name) if os.path.isdir(file_name) else read_table(file_name, **kwargs)
+
+
+def tile_of(x, y, tile_size):
+    """Returns the name of the square tile of the specified size containing the specified location."""
+    return f"{math.floor(x / tile_size)}_{math.floor(y / tile_size)}"
+
+
+def export_tiles(store, table, directory="tiles", **equals):
+    """Writes the results of each tile of a results table to an npz file, optionally only the records whose columns equal the specified values.
+
+    Each file has the location names and coordinates, the borehole lengths and spacings, E_max of shape
+    (num_locations, num_L_borehole, num_borehole_spacing) with NaN for the cases that are missing, and the errors of the
+    invalid columns, which are empty for the valid ones. The tiles are read from the store one at a time."""
+    os.makedirs(directory, exist_ok=True)
+    for tile in store.values(table, "tile"):
+        data_frame = store.read(table, tile=tile, **equals)
+        if len(data_frame) == 0:
+            continue
+        locations, i = np.unique(data_frame["Location"], return_inverse=True)
+        L_borehole, j = np.unique(data_frame["L_borehole"], return_inverse=True)
+        borehole_spacing, k = np.unique(data_frame["borehole_spacing"], return_inverse=True)
+        E_max = np.full((len(locations), len(L_borehole), len(borehole_spacing)), np.nan)
+        E_max[i, j, k] = data_frame["E_max"]
+        x, y = np.zeros(len(locations)), np.zeros(len(locations))
+        x[i], y[i] = data_frame["x"], data_frame["y"]
+        errors = np.full(len(locations), "", dtype=object)
+        errors[i] = data_frame["error"].fillna("")
+        path = os.path.join(directory, f"E_max_{tile}.npz")
+        # The file is written under a temporary name first so that readers never see a partial tile.
+        np.savez(path[:-4] + ".tmp.npz", location=locations.astype(str), x=x, y=y, L_borehole=L_borehole, borehole_spacing=borehole_spacing, E_max=E_max, error=errors.astype(str))
+        os.replace(path[:-4] + ".tmp.npz", path)
+
+
+if __name__ == "__main__":
+    from budapest import make_geologies
+    import tempfile
+    import tracemalloc
+    directory = tempfile.mkdtemp()
+    # Writes the Budapest geologies to a CSV file and reads them back.
+    rows = []
+    for n, geology in enumerate(make_geologies(v_groundwater="predefined")):
+        for layer in geology.layers:
+            rows.append({"location": geology.name, "x": 1000.0 * n, "y": 0.0, "T_surface": geology.T_surface, "q_geothermal": geology.q_geothermal, "unit": layer.material.name, "z_to": layer.z_to, **{name: getattr(layer.material if name != "velocity" else layer, name) for name in PROPERTIES}})
+    pd.DataFrame(rows).to_csv(os.path.join(directory, "columns.csv"), index=False)
+    for x, y, geology in read_columns(os.path.join(directory, "columns.csv"), chunk_size=7):
+        print(f"x={x:.0f} m, y={y:.0f} m, {geology}")
+    # Writes a synthetic gridded model whose quaternary and miocene units thin out towards the east and reads it back.
+    nx, ny = 300, 300
+    x, y = np.arange(nx) * 100.0, np.arange(ny) * 100.0
+    thickness = np.stack([np.broadcast_to(np.linspace(30, 0, nx), (ny, nx)), np.broadcast_to(np.linspace(200, 0, nx), (ny, nx)), np.full((ny, nx), 800.0)])
+    grid = os.path.join(directory, "grid")
+    os.makedirs(grid)
+    for name, value in [("x", x), ("y", y), ("T_surface", np.full((ny, nx), 11.0)), ("q_geothermal", np.full((ny, nx), 0.08)), ("z_to", -np.cumsum(thickness, axis=0))]:
+        np.save(os.path.join(grid, f"{name}.npy"), value)
+    pd.DataFrame({"unit": ["Quaternary Deposits", "Miocene Rocks", "Triassic Rocks"], "k_matrix": [3.0, 1.8, 2.5], "Cp_matrix": [1800, 840, 850], "rho_matrix": [1800, 2200, 2700], "porosity": [0.3, 0.1, 0.15], "velocity": [1e-8, 1e-9, 1e-8]}).to_csv(os.path.join(grid, "units.csv"), index=False)
+    tracemalloc.start()
+    num_columns, num_layers = 0, 0
+    for x, y, geology in read_columns(grid):
+        num_columns, num_layers = num_columns + 1, num_layers + len(geology.layers)
+    print(f"Read {num_columns} columns with {num_layers} layers, peak_memory={tracemalloc.get_traced_memory()[1]/1024**2:.1f} MiB")
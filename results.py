@@ -0,0 +1,82 @@
+import pandas as pd
+import numpy as np
+import sqlite3
+import time
+
+
+TYPES = {"TEXT": str, "REAL": float, "INTEGER": int}
+
+
+class ResultStore:
+    """This class stores results in an SQLite database in WAL mode, so each appended row is written atomically and an interrupted run loses at most the row being written.
+
+    Each table has typed columns declared by the caller plus the case hash, which is unique, and the time of writing."""
+
+    def __init__(self, path="results.sqlite"):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.columns = {}
+
+    def create_table(self, table, columns):
+        """Creates a table with the specified columns given as a dict of names and SQLite types (TEXT, REAL or INTEGER) unless it exists."""
+        for name, column_type in columns.items():
+            if column_type not in TYPES:
+                raise ValueError(f"Unsupported column type for {name}: {column_type}")
+        definitions = ", ".join(f'"{name}" {column_type}' for name, column_type in columns.items())
+        with self.connection:
+            self.connection.execute(f'CREATE TABLE IF NOT EXISTS "{table}" (case_hash TEXT PRIMARY KEY, {definitions}, time_written REAL)')
+        self.columns[table] = dict(columns)
+
+    def append(self, table, case_hash, record):
+        """Writes a record of the specified case in a single transaction replacing an earlier record of the same case."""
+        columns = self.columns[table]
+        values = [None if record.get(name) is None or (isinstance(record[name], float) and np.isnan(record[name])) else TYPES[column_type](record[name]) for name, column_type in columns.items()]
+        names = ", ".join(f'"{name}"' for name in columns)
+        placeholders = ", ".join("?" for _ in range(len(columns)+2))
+        with self.connection:
+            self.connection.execute(f'INSERT OR REPLACE INTO "{table}" (case_hash, {names}, time_written) VALUES ({placeholders})', [case_hash, *values, time.time()])
+
+    def get(self, table, case_hash):
+        """Returns the record of the specified case as a dict or None if there is none."""
+        cursor = self.connection.execute(f'SELECT * FROM "{table}" WHERE case_hash = ?', [case_hash])
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip([description[0] for description in cursor.description], row))
+
+    def __contains__(self, key):
+        table, case_hash = key
+        return self.connection.execute(f'SELECT 1 FROM "{table}" WHERE case_hash = ?', [case_hash]).fetchone() is not None
+
+    def read(self, table, **equals):
+        """Returns a table as a data frame in the order the records were written, optionally only the records whose columns equal the specified values."""
+        where = " AND ".join(f'"{name}" = ?' for name in equals)
+        return pd.read_sql_query(f'SELECT * FROM "{table}"{" WHERE " + where if where else ""} ORDER BY time_written', self.connection, params=list(equals.values()))
+
+    def values(self, table, column):
+        """Returns the distinct values of a column in ascending order."""
+        return [row[0] for row in self.connection.execute(f'SELECT DISTINCT "{column}" FROM "{table}" ORDER BY "{column}"')]
+
+    def export_excel(self, table, file_name):
+        """Writes a table to an Excel file without the bookkeeping columns."""
+        self.read(table).drop(columns=["case_hash", "time_written"]).to_excel(file_name, index=False)
+
+    def close(self):
+        self.connection.close()
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) == 4:
+        # Exports a table for the final report: python results.py <database> <table> <file_name>
+        ResultStore(sys.argv[1]).export_excel(sys.argv[2], sys.argv[3])
+    else:
+        import tempfile, os
+        store = ResultStore(os.path.join(tempfile.mkdtemp(), "results.sqlite"))
+        store.create_table("potentials", {"Geology": "TEXT", "L_borehole": "REAL", "borehole_spacing": "REAL", "E_max": "REAL"})
+        store.append("potentials", "a1", {"Geology": "B-38", "L_borehole": 200, "borehole_spacing": 20, "E_max": 21.161409})
+        store.append("potentials", "b2", {"Geology": "B-38", "L_borehole": 100, "borehole_spacing": 20, "E_max": np.nan})
+        print(("potentials", "a1") in store, store.get("potentials", "b2"))
+        print(store.read("potentials"))
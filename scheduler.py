@@ -0,0 +1,252 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from superposition import eval_response
+from metrics import CaseMetrics, MetricsLog
+from cache import case_hash, describe_case
+from mesh import mesh_version
+from utils import num_to_str, time_elapsed
+import multiprocessing
+import analytical
+import comsol
+import native
+import numpy as np
+import json
+import time
+import os
+
+
+class NativeBackend:
+    """This class evaluates cases with the native backend."""
+
+    def __init__(self, T_min=0.0, mesh=None, **kwargs):
+        self.version = mesh_version(native.AXISYMMETRIC_VERSION if kwargs.get("axisymmetric") else native.BACKEND_VERSION, mesh)
+        self.T_min, self.mesh, self.kwargs = T_min, mesh, kwargs
+
+    def start(self):
+        pass
+
+    def run(self, params, geology):
+        metrics = CaseMetrics(geology.name)
+        response = eval_response(native.init_model(params, geology, metrics, self.mesh, **self.kwargs), metrics=metrics)
+        return {"t": response.t, "T_undisturbed": response.T_undisturbed, "T_unit": response.T_unit, "E_max": response.E_max(self.T_min), "metrics": metrics.to_dict()}
+
+
+class AnalyticalBackend:
+    """This class evaluates cases with the semi-analytical backend, which is fast enough for mapping whole regions."""
+
+    version = analytical.BACKEND_VERSION
+
+    def __init__(self, T_min=0.0, **kwargs):
+        self.T_min, self.kwargs = T_min, kwargs
+
+    def start(self):
+        pass
+
+    def run(self, params, geology):
+        metrics = CaseMetrics(geology.name, verbose=False)
+        response = eval_response(analytical.init_model(params, geology, metrics, **self.kwargs), metrics=metrics)
+        return {"t": response.t, "T_undisturbed": response.T_undisturbed, "T_unit": response.T_unit, "E_max": response.E_max(self.T_min), "metrics": metrics.to_dict()}
+
+
+class ComsolBackend:
+    """This class evaluates cases with COMSOL using one client per worker process.
+
+    Each client takes a licence seat for as long as its worker lives, so the scheduler never starts more workers than
+    there are seats for this backend."""
+
+    holds_seat = True
+
+    def __init__(self, T_min=0.0, cores=4, mesh=None):
+        self.version = mesh_version(comsol.BACKEND_VERSION, mesh)
+        self.T_min, self.cores, self.mesh = T_min, cores, mesh
+        self.client = None
+
+    def start(self):
+        import mph
+        self.client = mph.start(cores=self.cores)
+
+    def run(self, params, geology):
+        metrics = CaseMetrics(geology.name)
+        try:
+            response = eval_response(comsol.init_model(self.client, params, geology, metrics, self.mesh), metrics=metrics)
+        finally:
+            self.client.clear()
+        return {"t": response.t, "T_undisturbed": response.T_undisturbed, "T_unit": response.T_unit, "E_max": response.E_max(self.T_min), "metrics": metrics.to_dict()}
+
+
+class FakeBackend:
+    """This class returns synthetic results after a delay and fails randomly, which is useful for testing the scheduler."""
+
+    version = "fake-1"
+
+    def __init__(self, T_min=0.0, delay=0.1, failure_rate=0.0):
+        self.T_min, self.delay, self.failure_rate = T_min, delay, failure_rate
+
+    def start(self):
+        self.rng = np.random.default_rng(os.getpid())
+
+    def run(self, params, geology):
+        time.sleep(self.delay)
+        if self.rng.random() < self.failure_rate:
+            raise RuntimeError("Simulated solver failure.")
+        t = np.arange(12*params.num_years+1) / 12
+        T_undisturbed = np.full(len(t), geology.T_surface + 0.5 * geology.q_geothermal * params.L_borehole / 2.5)
+        T_unit = -100 / params.L_borehole * (1 + np.log1p(t) * 20 / params.borehole_spacing)
+        response = {"t": t, "T_undisturbed": T_undisturbed, "T_unit": T_unit}
+        response["E_max"] = np.min((self.T_min - T_undisturbed) / T_unit)
+        return response
+
+
+def _describe_case(geology, params):
+    return f"geology={geology.name}, L_borehole={num_to_str(params.L_borehole)} m, borehole_spacing={num_to_str(params.borehole_spacing)} m"
+
+
+_backend, _seats = None, None
+
+
+def _init_worker(backend, seats):
+    global _backend, _seats
+    _backend, _seats = backend, seats
+    _backend.start()
+
+
+def _run_case(params, geology):
+    with _seats:
+        return _backend.run(params, geology)
+
+
+class Scheduler:
+    """This class spreads simulation cases over a pool of worker processes each holding its own solver backend.
+
+    Finished cases are appended to a journal file, so an interrupted run continues where it stopped. Failed cases are
+    retried and at most max_seats cases are solved at the same time regardless of the number of workers, while at most
+    max_pending cases are queued for them. Backends whose workers hold a seat for their whole life, like COMSOL, get no
+    more than max_seats workers. The metrics returned by the backend are written to the metrics log, which is either a
+    MetricsLog or a path to one."""
+
+    def __init__(self, backend, num_workers=4, max_seats=None, retries=2, journal="progress.jsonl", cache=None, metrics_log=None, max_pending=None):
+        self.backend, self.num_workers, self.retries = backend, num_workers, retries
+        self.max_seats = num_workers if max_seats is None else max_seats
+        self.max_pending = 2 * num_workers if max_pending is None else max_pending
+        self.journal, self.cache = journal, cache
+        self.metrics_log = MetricsLog(metrics_log) if isinstance(metrics_log, str) else metrics_log
+
+    @property
+    def pool_size(self):
+        """The number of worker processes, which is limited to max_seats if the workers of the backend hold seats."""
+        return min(self.num_workers, self.max_seats) if getattr(self.backend, "holds_seat", False) else self.num_workers
+
+    def read_journal(self):
+        """Returns the journal records of finished cases by case key."""
+        records = {}
+        if self.journal is not None and os.path.exists(self.journal):
+            with open(self.journal) as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # The last line may be incomplete if the process was killed while writing it.
+                        continue
+                    if record["status"] == "done":
+                        records[record["key"]] = record
+        return records
+
+    def write_journal(self, record):
+        """Appends a record to the journal and flushes it to disk."""
+        if self.journal is not None:
+            with open(self.journal, "a") as file:
+                file.write(json.dumps(record) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+
+    def run(self, cases):
+        """Runs the specified (geology, params) cases and yields (index, key, result) tuples as they finish.
+
+        The cases may be any iterable. They are read only as fast as the workers take them, so at most max_pending cases
+        are held in memory however many there are. Cases found in the journal are yielded as they are read with results
+        from the cache if one is available and with the journal record otherwise. Cases that fail more than the allowed
+        number of retries are yielded with None."""
+
+        finished = self.read_journal()
+
+        seats = multiprocessing.Semaphore(self.max_seats)
+
+        executor = None
+        attempts = {}
+        futures = {}
+
+        def submit(i, key, geology, params):
+            attempts[i] = attempts.get(i, 0) + 1
+            futures[executor.submit(_run_case, params, geology)] = (i, key, geology, params, time.time())
+
+        def collect():
+            future = next(as_completed(futures))
+            i, key, geology, params, tic = futures.pop(future)
+            toc = time.time()
+            try:
+                result = future.result()
+            except Exception as error:
+                if attempts[i] <= self.retries:
+                    print(f"Retrying {_describe_case(geology, params)} after error: {error}")
+                    submit(i, key, geology, params)
+                else:
+                    print(f"Giving up {_describe_case(geology, params)} after {attempts.pop(i)} attempts: {error}")
+                    self.write_journal({"key": key, "status": "failed", "geology": geology.name, "error": str(error)})
+                    yield i, key, None
+                return
+            del attempts[i]
+            metrics = result.pop("metrics", None)
+            if metrics is not None and self.metrics_log is not None:
+                self.metrics_log.write({"key": key, **metrics, "L_borehole": float(params.L_borehole), "borehole_spacing": float(params.borehole_spacing), "thickness": float(geology.thickness), "time_case": toc-tic})
+            if self.cache is not None:
+                self.cache.put(key, {**result, "T_min": self.backend.T_min, "case": describe_case(params, geology), "backend": self.backend.version})
+            record = {"key": key, "status": "done", "geology": geology.name, "L_borehole": float(params.L_borehole), "borehole_spacing": float(params.borehole_spacing), "E_max": float(result["E_max"]), "time_elapsed": toc-tic}
+            self.write_journal(record)
+            print(f"time_elapsed={time_elapsed(toc-tic)}, {_describe_case(geology, params)}, E_max={num_to_str(result['E_max'])} MWh")
+            yield i, key, result
+
+        try:
+            for i, (geology, params) in enumerate(cases):
+                key = case_hash(params, geology, self.backend.version)
+                if key in finished:
+                    entry = self.cache.get(key) if self.cache is not None else None
+                    yield i, key, entry if entry is not None else finished[key]
+                    continue
+                if executor is None:
+                    executor = ProcessPoolExecutor(max_workers=self.pool_size, initializer=_init_worker, initargs=(self.backend, seats))
+                submit(i, key, geology, params)
+                while len(futures) >= self.max_pending:
+                    yield from collect()
+            while len(futures) > 0:
+                yield from collect()
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+
+def run_cases(cases, backend, **kwargs):
+    """Runs the specified (geology, params) cases with a scheduler and returns the results in the order of the cases."""
+    results = [None] * len(cases)
+    for i, key, result in Scheduler(backend, **kwargs).run(cases):
+        results[i] = result
+    return results
+
+
+if __name__ == "__main__":
+    from budapest import make_geologies
+    from comsol import Parameters
+    from itertools import product
+    import tempfile
+    monthly_fractions = [0.194717, 0.17216, 0.128944, 0.075402, 0.024336, 0, 0, 0, 0.025227, 0.076465, 0.129925, 0.172824]
+    geologies = make_geologies(v_groundwater=0)
+    cases = [(geology, Parameters(L_borehole=L_borehole, D_borehole=0.150, borehole_spacing=borehole_spacing, num_years=50, E_annual=0, monthly_fractions=monthly_fractions)) for geology, L_borehole, borehole_spacing in product(geologies, [100, 200], [20, 100])]
+    journal = os.path.join(tempfile.mkdtemp(), "progress.jsonl")
+    # Runs the cases with a flaky fake backend using eight workers but only four solver seats.
+    tic = time.time()
+    results = run_cases(cases, FakeBackend(failure_rate=0.2), num_workers=8, max_seats=4, journal=journal)
+    toc = time.time()
+    print(f"Solved {sum(result is not None for result in results)}/{len(cases)} cases in {toc-tic:.1f}s.")
+    # Rerunning takes the finished cases from the journal.
+    tic = time.time()
+    results = run_cases(cases, FakeBackend(failure_rate=0.2), num_workers=8, max_seats=4, journal=journal)
+    toc = time.time()
+    print(f"Solved {sum(result is not None for result in results)}/{len(cases)} cases in {toc-tic:.1f}s.")
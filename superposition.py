@@ -0,0 +1,221 @@
+from utils import num_to_str, time_elapsed
+import scipy.optimize
+import numpy as np
+import time
+
+
+class LinearResponse:
+    """This class stores the mean borehole wall temperature response of a model that is linear in the annual heat extraction."""
+
+    def __init__(self, t, T_undisturbed, T_unit):
+        self.t = np.asarray(t)
+        self.T_undisturbed = np.asarray(T_undisturbed)
+        self.T_unit = np.asarray(T_unit)
+
+    def T_ave(self, E_annual):
+        """Returns the mean borehole wall temperature time series [degC] for the specified annual heat extraction [MWh]."""
+        return self.T_undisturbed + E_annual * self.T_unit
+
+    def T_min(self, E_annual):
+        """Returns the coldest mean borehole wall temperature [degC] for the specified annual heat extraction(s) [MWh]."""
+        E_annual = np.asarray(E_annual, dtype=float)
+        return np.min(self.T_undisturbed + E_annual[..., None] * self.T_unit, axis=-1)
+
+    def E_max(self, T_min):
+        """Returns the maximal annual heat extraction [MWh] that keeps the mean borehole wall temperature above T_min."""
+        if np.min(self.T_undisturbed) < T_min:
+            raise ValueError(f"The undisturbed temperature is already below T_min={num_to_str(T_min)} \xb0C.")
+        cooling = self.T_unit < 0
+        if not np.any(cooling):
+            return np.inf
+        return np.min((T_min - self.T_undisturbed[cooling]) / self.T_unit[cooling])
+
+    def __str__(self):
+        return f"LinearResponse(num_times={len(self.t)}, T_undisturbed={num_to_str(np.min(self.T_undisturbed))} \xb0C, T_unit={num_to_str(np.min(self.T_unit))} \xb0C/MWh)"
+
+
+def eval_response(model, E_reference=10, solve_undisturbed=False, metrics=None):
+    """Evaluates the linear mean borehole wall temperature response of the specified model.
+
+    By default only one simulation is run and the undisturbed response is taken from the initial state, which is the
+    steady-state geotherm of the model. With solve_undisturbed=True it is simulated separately with no heat extraction.
+    The solve wall times are recorded into the specified CaseMetrics if any."""
+    def solve(E_annual):
+        tic = time.time()
+        model.parameter("E_annual", f"{num_to_str(E_annual)}[MWh]")
+        model.solve()
+        if metrics is not None:
+            metrics.record_solve(time.time()-tic)
+    tic = time.time()
+    solve(E_reference)
+    t = model.evaluate("t", "a")
+    T_ave = model.evaluate("T_ave", "degC")
+    if solve_undisturbed:
+        solve(0)
+        T_undisturbed = model.evaluate("T_ave", "degC")
+    else:
+        T_undisturbed = np.full(len(T_ave), T_ave[0])
+    response = LinearResponse(t, T_undisturbed, (T_ave - T_undisturbed) / E_reference)
+    toc = time.time()
+    print(f"time_elapsed={time_elapsed(toc-tic)}, E_reference={num_to_str(E_reference)} MWh, T_unit={num_to_str(np.min(response.T_unit))} \xb0C/MWh")
+    return response
+
+
+def eval_cached_response(cache, key, init_model, T_min=None, metrics=None, case=None, backend=None):
+    """Returns the linear response stored in the cache under the specified key or evaluates and stores it using the model returned by init_model().
+
+    If T_min is specified, the derived E_max is stored along with the response and so are the case description returned
+    by cache.describe_case() and the backend version if specified. The solve wall times are recorded into the specified CaseMetrics if any, so
+    init_model() should collect into the same metrics."""
+    entry = cache.get(key)
+    if entry is not None:
+        print(f"Using cached response {key[:12]}")
+        return LinearResponse(entry["t"], entry["T_undisturbed"], entry["T_unit"])
+    response = eval_response(init_model(), metrics=metrics)
+    entry = {"t": response.t, "T_undisturbed": response.T_undisturbed, "T_unit": response.T_unit}
+    if T_min is not None:
+        entry.update(T_min=T_min, E_max=response.E_max(T_min))
+    if case is not None:
+        entry["case"] = case
+    if backend is not None:
+        entry["backend"] = backend
+    cache.put(key, entry)
+    return response
+
+
+def find_E_max(evaluate, T_target, T_undisturbed=None, E_reference=1, E_upper=100000, ttol=1e-6, xtol=0.001):
+    """Finds the annual heat extraction for which the minimum of evaluate(E_annual) equals T_target.
+
+    The root is first solved in closed form assuming that evaluate() is linear in E_annual and then verified, so a
+    linear evaluate() costs two evaluations if T_undisturbed is known and three otherwise. If the verification fails, the
+    root is bracketed and refined with Brent's method at the cost of further evaluations. Returns the root, the
+    temperatures evaluated at the root and the number of evaluations used."""
+
+    num_evaluations = 0
+    evaluated = {}
+
+    def T_min(E_annual):
+        nonlocal num_evaluations
+        num_evaluations += 1
+        evaluated[E_annual] = evaluate(E_annual)
+        return np.min(evaluated[E_annual])
+
+    if T_undisturbed is None:
+        num_evaluations += 1
+        T_undisturbed = evaluate(0)
+
+    T_reference = evaluate(E_reference)
+    num_evaluations += 1
+
+    T_undisturbed = np.broadcast_to(T_undisturbed, np.shape(T_reference))
+    response = LinearResponse(np.arange(len(T_reference)), T_undisturbed, (T_reference - T_undisturbed) / E_reference)
+
+    E_max = min(response.E_max(T_target), E_upper)
+
+    T_root = T_min(E_max)
+
+    if np.abs(T_root - T_target) <= ttol:
+        return E_max, evaluated[E_max], num_evaluations
+
+    # The response is not linear, so the root is bracketed starting from the linear estimate.
+    E_lower = 0
+    while T_root > T_target:
+        if E_max >= E_upper:
+            raise ValueError(f"The root is not bracketed by E_upper={num_to_str(E_upper)} MWh.")
+        E_lower, E_max = E_max, min(2 * E_max, E_upper)
+        T_root = T_min(E_max)
+
+    E_max = scipy.optimize.brentq(lambda E_annual: T_min(E_annual) - T_target, E_lower, E_max, xtol=xtol)
+
+    # Brent's method may return a point it did not evaluate last.
+    if E_max not in evaluated:
+        T_min(E_max)
+
+    return E_max, evaluated[E_max], num_evaluations
+
+
+def find_influence_radius(eval_E_max, B_isolated, fraction=0.95, B_lower=20, B_upper=140, xtol=1.0):
+    """Finds the borehole spacing at which E_max per borehole, given by eval_E_max(borehole_spacing), reaches the specified fraction of its isolated value.
+
+    The isolated value is E_max at B_isolated, which should be far beyond the thermal reach of the boreholes. Far from
+    the knee the shortfall of E_max decays like exp(-B**2/(4*a*t)), so its logarithm is nearly quadratic in B and
+    Brent's method spends its evaluations close to the root. The bracket is extended towards B_isolated if needed.
+    Returns the radius, a bound on its error that is at most xtol, E_max at B_isolated and the number of evaluations."""
+
+    E_max = {}
+
+    def evaluate(borehole_spacing):
+        if borehole_spacing not in E_max:
+            E_max[borehole_spacing] = eval_E_max(borehole_spacing)
+        return E_max[borehole_spacing]
+
+    E_isolated = evaluate(B_isolated)
+
+    def log_shortfall(borehole_spacing):
+        # The shortfall is positive below the radius and negative above it. The floor keeps the logarithm finite
+        # where E_max exceeds the isolated value by round-off.
+        shortfall = max(1 - evaluate(borehole_spacing) / E_isolated, 1e-12)
+        return np.log(shortfall) - np.log(1 - fraction)
+
+    if log_shortfall(B_lower) <= 0:
+        raise ValueError(f"E_max already exceeds {num_to_str(fraction)} of its isolated value at B_lower={num_to_str(B_lower)} m.")
+
+    while log_shortfall(B_upper) > 0:
+        if B_upper >= B_isolated:
+            raise ValueError(f"E_max does not reach {num_to_str(fraction)} of its isolated value before B_isolated={num_to_str(B_isolated)} m.")
+        B_lower, B_upper = B_upper, min(2 * B_upper, B_isolated)
+
+    radius = scipy.optimize.brentq(log_shortfall, B_lower, B_upper, xtol=xtol)
+
+    # Since E_max increases with the spacing, the root lies between the closest evaluated spacings on either side.
+    below = max(B for B in E_max if B != B_isolated and log_shortfall(B) > 0)
+    above = min(B for B in E_max if log_shortfall(B) <= 0)
+    tolerance = max(radius - below, above - radius)
+
+    return radius, tolerance, E_isolated, len(E_max)
+
+
+def find_groundwater_threshold(eval_E_max, E_no_flow, v_lower, v_upper=1e-5, departure=0.01, factor=10, xtol=0.01, v_min=1e-15):
+    """Finds the groundwater flow velocity at which E_max, given by eval_E_max(velocity), departs from its value without groundwater flow by the specified fraction.
+
+    v_lower should be a velocity that clearly has no effect, such as one given by a Peclet number prescreen. If E_max
+    already departs at v_lower, the velocity is stepped down by the specified factor until it does not, or an error is
+    raised below v_min. The velocity is then stepped up by the factor until the departure is exceeded and the bracket is
+    refined with Brent's method on log10 of the velocity to within xtol decades. At low velocities the departure grows
+    like velocity**2, so its logarithm is nearly linear in log10 of the velocity. Returns the threshold velocity, the
+    closest evaluated velocities below and above it and the number of evaluations."""
+
+    E_max = {}
+
+    def evaluate(velocity):
+        if velocity not in E_max:
+            E_max[velocity] = eval_E_max(velocity)
+        return E_max[velocity]
+
+    def log_departure(log_velocity):
+        # The floor keeps the logarithm finite where the velocity has no effect at all.
+        relative_departure = max(abs(evaluate(10**log_velocity) / E_no_flow - 1), 1e-12)
+        return np.log(relative_departure) - np.log(departure)
+
+    # The search starts from a velocity at which E_max does not yet depart, which the prescreen does not guarantee.
+    log_upper = np.log10(v_lower)
+    while log_departure(log_upper) > 0:
+        if log_upper <= np.log10(v_min):
+            raise ValueError(f"E_max departs by more than {num_to_str(100*departure)} % from its value without groundwater flow already at v_min={num_to_str(v_min)} m/s.")
+        log_upper = max(log_upper - np.log10(factor), np.log10(v_min))
+
+    while True:
+        if log_upper >= np.log10(v_upper):
+            raise ValueError(f"E_max does not depart by {num_to_str(100*departure)} % from its value without groundwater flow below v_upper={num_to_str(v_upper)} m/s.")
+        log_lower, log_upper = log_upper, min(log_upper + np.log10(factor), np.log10(v_upper))
+        if log_departure(log_upper) > 0:
+            break
+
+    # The bracket has a sign change by construction, so brentq() can not fail on it.
+    threshold = 10**scipy.optimize.brentq(log_departure, log_lower, log_upper, xtol=xtol)
+
+    departs = {velocity: abs(E / E_no_flow - 1) > departure for velocity, E in E_max.items()}
+    below = max(velocity for velocity in E_max if not departs[velocity])
+    above = min(velocity for velocity in E_max if departs[velocity])
+
+    return threshold, below, above, len(E_max)
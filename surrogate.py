@@ -0,0 +1,200 @@
+from geology import GeologyArrays, as_arrays
+from types import SimpleNamespace
+import scipy.optimize
+import pandas as pd
+import numpy as np
+import json
+import os
+
+
+FEATURES = ["log_L_borehole", "log_borehole_spacing", "log_k", "log_C", "T_middle", "log_velocity"]
+
+
+def features(params, geology):
+    """Returns the surrogate features of a case: the borehole length, the spacing, the properties averaged along the borehole, the undisturbed temperature at its midpoint and the mean groundwater velocity."""
+    arrays = as_arrays(geology)
+    L_borehole = params.L_borehole
+    averages = arrays.averages(0, -L_borehole)
+    weights = np.maximum(np.minimum(arrays.z_from, 0) - np.maximum(arrays.z_to, -L_borehole), 0)
+    velocity = np.sum(weights * arrays.velocity) / np.sum(weights)
+    # Velocities below 1e-11 m/s have no effect, so they are cut off to keep the logarithm finite.
+    return np.array([np.log(L_borehole), np.log(params.borehole_spacing), np.log(averages["k"]), np.log(averages["C"]), float(arrays.T_initial(-0.5*L_borehole)), np.log10(max(velocity, 1e-11))])
+
+
+def _case_from_description(case):
+    """Rebuilds the parameters and a columnar geology from a description returned by cache.describe_case()."""
+    case = json.loads(case)
+    params = SimpleNamespace(**{key: value for key, value in case["params"].items() if key != "type"})
+    geology = case["geology"]
+    if geology["type"] == "GeologyArrays":
+        arrays = GeologyArrays(None, **{key: value for key, value in geology.items() if key != "type"})
+    else:
+        layers = geology["layers"]
+        arrays = GeologyArrays(None, geology["T_surface"], geology["q_geothermal"],
+            z_from=[layer["z_from"] for layer in layers],
+            z_to=[layer["z_to"] for layer in layers],
+            k=[layer["material"]["k"] for layer in layers],
+            Cp=[layer["material"]["Cp"] for layer in layers],
+            rho=[layer["material"]["rho"] for layer in layers],
+            velocity=[layer.get("velocity", 0) for layer in layers])
+    return params, arrays
+
+
+def load_results(file_name, geologies, D_borehole=0.150, num_years=50):
+    """Returns the finished cases of a results file as (params, geology, E_max) tuples."""
+    by_name = {geology.name: geology for geology in geologies}
+    data_frame = pd.read_excel(file_name)
+    cases = []
+    for _, row in data_frame[data_frame["E_max"].notna()].iterrows():
+        params = SimpleNamespace(L_borehole=row["L_borehole"], D_borehole=D_borehole, borehole_spacing=row["borehole_spacing"], num_years=num_years)
+        cases.append((params, by_name[row["Geology"]], row["E_max"]))
+    return cases
+
+
+def load_cache(cache, backend, T_min=0.0):
+    """Returns the cached cases of the specified backend version that were stored with a case description and an E_max for the specified T_min as (params, geology, E_max) tuples.
+
+    The backends differ by up to a few percent, so mixing them would make the surrogate fit their differences."""
+    cases = []
+    for file_name in sorted(os.listdir(cache.directory)):
+        if not file_name.endswith(".npz") or file_name.endswith(".tmp.npz"):
+            continue
+        entry = cache.get(file_name[:-4])
+        if entry is None or "case" not in entry or "E_max" not in entry or str(entry.get("backend")) != backend or float(entry.get("T_min", np.nan)) != T_min:
+            continue
+        params, geology = _case_from_description(str(entry["case"]))
+        cases.append((params, geology, float(entry["E_max"])))
+    return cases
+
+
+class GaussianProcess:
+    """This class implements Gaussian process regression with an anisotropic squared exponential kernel in NumPy.
+
+    The inputs and the outputs are standardized, and the length scales, the signal variance and the noise variance are
+    fitted by maximizing the log marginal likelihood."""
+
+    def __init__(self, min_noise=1e-6):
+        self.min_noise = min_noise
+
+    def _kernel(self, A, B):
+        d = (A[:, None, :] - B[None, :, :]) / self.length_scales
+        return self.signal_variance * np.exp(-0.5 * np.sum(d**2, axis=2))
+
+    def _set_hyperparameters(self, theta):
+        d = self.X.shape[1]
+        self.length_scales = np.exp(theta[:d])
+        self.signal_variance = np.exp(theta[d])
+        self.noise_variance = np.exp(theta[d+1]) + self.min_noise
+
+    def _neg_log_likelihood(self, theta):
+        self._set_hyperparameters(theta)
+        K = self._kernel(self.X, self.X) + self.noise_variance * np.eye(len(self.X))
+        try:
+            L = np.linalg.cholesky(K)
+        except np.linalg.LinAlgError:
+            return 1e10
+        alpha = np.linalg.solve(L.T, np.linalg.solve(L, self.y))
+        return 0.5 * self.y @ alpha + np.sum(np.log(np.diag(L)))
+
+    def fit(self, X, y):
+        X, y = np.asarray(X, dtype=float), np.asarray(y, dtype=float)
+        self.X_mean, self.X_std = np.mean(X, axis=0), np.std(X, axis=0)
+        self.X_std[self.X_std == 0] = 1
+        self.y_mean, self.y_std = np.mean(y), np.std(y)
+        self.X, self.y = (X - self.X_mean) / self.X_std, (y - self.y_mean) / self.y_std
+        theta = np.concatenate((np.zeros(X.shape[1]), [0.0, np.log(1e-2)]))
+        bounds = [(np.log(1e-2), np.log(1e2))] * X.shape[1] + [(np.log(1e-2), np.log(1e2)), (np.log(1e-8), np.log(1.0))]
+        result = scipy.optimize.minimize(self._neg_log_likelihood, theta, method="L-BFGS-B", bounds=bounds)
+        self._set_hyperparameters(result.x)
+        K = self._kernel(self.X, self.X) + self.noise_variance * np.eye(len(self.X))
+        self.K_inverse = np.linalg.inv(K)
+        self.alpha = self.K_inverse @ self.y
+        return self
+
+    def predict(self, X):
+        """Returns the predictive means and standard deviations at the specified inputs."""
+        X = (np.atleast_2d(X) - self.X_mean) / self.X_std
+        k = self._kernel(X, self.X)
+        mean = k @ self.alpha
+        variance = self.signal_variance - np.sum((k @ self.K_inverse) * k, axis=1)
+        return self.y_mean + self.y_std * mean, self.y_std * np.sqrt(np.maximum(variance, 0))
+
+    def covariance(self, X):
+        """Returns the posterior covariance of the latent function at the specified inputs."""
+        X = (np.atleast_2d(X) - self.X_mean) / self.X_std
+        k = self._kernel(X, self.X)
+        return self.y_std**2 * (self._kernel(X, X) - k @ self.K_inverse @ k.T)
+
+    def loo_residuals(self):
+        """Returns the leave-one-out residuals of the training outputs in closed form."""
+        return self.y_std * self.alpha / np.diag(self.K_inverse)
+
+
+class Surrogate:
+    """This class predicts E_max from the features of a case with a Gaussian process fitted to log(E_max) of finished simulations."""
+
+    def fit(self, cases):
+        """Fits the surrogate to (params, geology, E_max) tuples."""
+        self.X = np.array([features(params, geology) for params, geology, _ in cases])
+        self.gp = GaussianProcess().fit(self.X, np.log([E_max for _, _, E_max in cases]))
+        return self
+
+    def predict_features(self, X):
+        """Returns the median and the standard deviation of E_max at the specified feature vectors."""
+        mean, std = self.gp.predict(X)
+        E_max = np.exp(mean)
+        return E_max, E_max * std
+
+    def predict(self, params, geology):
+        """Returns the predicted E_max of a case and its standard deviation."""
+        E_max, std = self.predict_features(features(params, geology))
+        return E_max[0], std[0]
+
+    def loo_errors(self):
+        """Returns the relative leave-one-out errors of E_max over the training cases."""
+        return np.exp(self.gp.loo_residuals()) - 1
+
+    def recommend(self, candidates, num_cases=10):
+        """Returns the indices of the (params, geology) candidates whose simulation reduces the total predictive variance over all candidates the most.
+
+        The candidates are picked greedily. Since the posterior variance of a Gaussian process does not depend on the
+        simulated values, each pick is conditioned on the earlier picks without running them."""
+        X = np.array([features(params, geology) for params, geology in candidates])
+        covariance = self.gp.covariance(X)
+        noise = self.gp.y_std**2 * self.gp.noise_variance
+        picks = []
+        for _ in range(min(num_cases, len(candidates))):
+            reduction = np.sum(covariance**2, axis=0) / (np.diag(covariance) + noise)
+            reduction[picks] = -np.inf
+            i = int(np.argmax(reduction))
+            picks.append(i)
+            covariance = covariance - np.outer(covariance[:, i], covariance[i, :]) / (covariance[i, i] + noise)
+        return picks
+
+
+if __name__ == "__main__":
+    from budapest import make_geologies
+    from comsol import Parameters
+    from itertools import product
+    import time
+    # Trains the surrogate on the finished simulations.
+    cases = load_results("results_without_groundwater_flow.xlsx", make_geologies(v_groundwater=0))
+    cases += load_results("results_with_groundwater_flow.xlsx", make_geologies(v_groundwater="predefined"))
+    surrogate = Surrogate().fit(cases)
+    print("Length scales:", ", ".join(f"{name}={scale:.3g}" for name, scale in zip(FEATURES, surrogate.gp.length_scales)))
+    errors = surrogate.loo_errors()
+    print(f"Leave-one-out errors: RMS={100*np.sqrt(np.mean(errors**2)):.2f}%, max={100*np.max(np.abs(errors)):.2f}%")
+    # Times single predictions.
+    X = surrogate.X[:1]
+    tic = time.perf_counter()
+    for i in range(10000):
+        surrogate.predict_features(X)
+    toc = time.perf_counter()
+    print(f"Prediction time: {1e6*(toc-tic)/10000:.1f} \xb5s")
+    # Recommends new cases from a grid of borehole lengths and spacings.
+    geologies = make_geologies(v_groundwater=0) + make_geologies(v_groundwater="predefined")
+    candidates = [(Parameters(L_borehole=L_borehole, D_borehole=0.150, borehole_spacing=borehole_spacing, num_years=50, E_annual=0), geology) for geology, L_borehole, borehole_spacing in product(geologies, [50, 100, 150, 200, 300], [10, 20, 50, 100])]
+    for i in surrogate.recommend(candidates, 10):
+        params, geology = candidates[i]
+        E_max, std = surrogate.predict(params, geology)
+        print(f"geology={geology.name}, has_groundwater_flow={geology.has_groundwater_flow}, L_borehole={params.L_borehole} m, borehole_spacing={params.borehole_spacing} m, E_max={E_max:.2f}\xb1{std:.2f} MWh")
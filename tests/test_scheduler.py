@@ -0,0 +1,78 @@
+from scheduler import ComsolBackend, FakeBackend, Scheduler, run_cases
+from budapest import make_geologies
+from comsol import Parameters
+from itertools import product
+import json
+
+
+def make_cases():
+    geologies = make_geologies(v_groundwater=0)[:3]
+    return [(geology, Parameters(L_borehole=L_borehole, D_borehole=0.150, borehole_spacing=borehole_spacing, num_years=2, E_annual=0)) for geology, L_borehole, borehole_spacing in product(geologies, [100, 200], [20, 100])]
+
+
+def read_records(journal):
+    with open(journal) as file:
+        return [json.loads(line) for line in file]
+
+
+def test_failed_cases_are_retried(tmp_path):
+    cases = make_cases()
+    # The chance of a case failing 16 times in a row is 2**-16.
+    results = run_cases(cases, FakeBackend(delay=0.01, failure_rate=0.5), num_workers=4, retries=15, journal=str(tmp_path / "progress.jsonl"))
+    assert all(result is not None for result in results)
+
+
+def test_cases_are_given_up_after_retries(tmp_path):
+    journal = str(tmp_path / "progress.jsonl")
+    cases = make_cases()
+    results = run_cases(cases, FakeBackend(delay=0.01, failure_rate=1.0), num_workers=4, retries=1, journal=journal)
+    assert all(result is None for result in results)
+    records = read_records(journal)
+    assert len(records) == len(cases) and all(record["status"] == "failed" for record in records)
+
+
+def test_finished_cases_are_taken_from_journal(tmp_path):
+    journal = str(tmp_path / "progress.jsonl")
+    cases = make_cases()
+    first = run_cases(cases, FakeBackend(delay=0.01), num_workers=4, journal=journal)
+    # Every case would fail if it were solved again.
+    second = run_cases(cases, FakeBackend(delay=0.01, failure_rate=1.0), num_workers=4, retries=0, journal=journal)
+    assert [result["E_max"] for result in first] == [result["E_max"] for result in second]
+    assert len(read_records(journal)) == len(cases)
+
+
+def test_truncated_last_journal_line_is_ignored(tmp_path):
+    journal = str(tmp_path / "progress.jsonl")
+    cases = make_cases()
+    run_cases(cases[:2], FakeBackend(delay=0.01), num_workers=2, journal=journal)
+    with open(journal, "a") as file:
+        file.write('{"key": "abc", "status": "do')
+    scheduler = Scheduler(FakeBackend(delay=0.01), num_workers=2, journal=journal)
+    assert len(scheduler.read_journal()) == 2
+    results = [None] * len(cases)
+    for i, key, result in scheduler.run(cases):
+        results[i] = result
+    assert all(result is not None for result in results)
+
+
+def test_cases_are_read_lazily(tmp_path):
+    cases = make_cases() * 3
+    max_pending = 3
+    num_read, num_finished, max_in_flight = 0, 0, 0
+
+    def read_cases():
+        nonlocal num_read
+        for case in cases:
+            num_read += 1
+            yield case
+
+    for i, key, result in Scheduler(FakeBackend(delay=0.01), num_workers=2, max_pending=max_pending, journal=None).run(read_cases()):
+        num_finished += 1
+        max_in_flight = max(max_in_flight, num_read - num_finished + 1)
+    assert num_finished == len(cases)
+    assert max_in_flight <= max_pending
+
+
+def test_comsol_workers_are_limited_to_seats():
+    assert Scheduler(ComsolBackend(), num_workers=8, max_seats=4).pool_size == 4
+    assert Scheduler(FakeBackend(), num_workers=8, max_seats=4).pool_size == 8
@@ -0,0 +1,66 @@
+from step_response import StepResponse, StepResponseLibrary, geometric_times
+from native import SECONDS_PER_YEAR
+from budapest import make_geologies
+import numpy as np
+import pytest
+
+
+class FakeModel:
+    """This class stands in for a model whose mean borehole wall temperature decreases logarithmically in time."""
+
+    def __init__(self, params, tlist=None):
+        self.tlist = np.arange(12*params.num_years+1) * SECONDS_PER_YEAR / 12 if tlist is None else np.asarray(tlist)
+        self.E_annual = 0
+
+    def parameter(self, name, value):
+        self.E_annual = float(value.split("[")[0])
+
+    def solve(self):
+        pass
+
+    def evaluate(self, expression, unit):
+        if expression == "t":
+            return self.tlist
+        return 10 - 0.1 * self.E_annual * np.log1p(self.tlist / 3600)
+
+
+def make_library(tmp_path):
+    calls = []
+    def init_model(params, geology, tlist=None):
+        calls.append((params.num_years, tlist))
+        return FakeModel(params, tlist)
+    return StepResponseLibrary(str(tmp_path)), init_model, calls
+
+
+def test_matching_request_is_reused(tmp_path):
+    library, init_model, calls = make_library(tmp_path)
+    geology = make_geologies(v_groundwater=0)[0]
+    first = library.get_or_compute(geology, 200, 20, 0.150, 10, init_model, "fake-1")
+    second = library.get_or_compute(geology, 200, 20, 0.150, 10, init_model, "fake-1")
+    assert len(calls) == 1
+    assert np.array_equal(first.g, second.g)
+
+
+def test_mismatched_request_is_recomputed(tmp_path):
+    library, init_model, calls = make_library(tmp_path)
+    geology = make_geologies(v_groundwater=0)[0]
+    library.get_or_compute(geology, 200, 20, 0.150, 10, init_model, "fake-1")
+    # A longer simulated time, a finer time grid and another backend each need a step response of their own.
+    longer = library.get_or_compute(geology, 200, 20, 0.150, 20, init_model, "fake-1")
+    finer = library.get_or_compute(geology, 200, 20, 0.150, 10, init_model, "fake-1", tlist=geometric_times(10*SECONDS_PER_YEAR))
+    library.get_or_compute(geology, 200, 20, 0.150, 10, init_model, "fake-2")
+    assert len(calls) == 4
+    assert longer.t[-1] == pytest.approx(20*SECONDS_PER_YEAR)
+    assert finer.t[1] == 3600
+
+
+def test_interpolation_outside_stored_times_raises():
+    t = np.arange(12*10+1) * SECONDS_PER_YEAR / 12
+    step_response = StepResponse(t, np.log1p(t / 3600), 10)
+    step_response.interpolate(t[1:])
+    with pytest.raises(ValueError):
+        step_response.interpolate([3600])
+    with pytest.raises(ValueError):
+        step_response.interpolate([20*SECONDS_PER_YEAR])
+    with pytest.raises(ValueError):
+        step_response.T_ave_monthly(1, np.full(12, 1/12), 20)
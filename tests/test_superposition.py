@@ -0,0 +1,30 @@
+from superposition import find_groundwater_threshold
+import numpy as np
+import pytest
+
+
+def eval_E_max(velocity):
+    # E_max departs from its value without groundwater flow by x/(1+x), where x=(velocity/1e-7)**2.
+    return 10 / (1 + (velocity / 1e-7)**2)
+
+
+# The departure of 1 % is reached at x=1/99.
+v_threshold = 1e-7 / np.sqrt(99)
+
+
+def test_threshold_is_found_from_a_velocity_without_effect():
+    threshold, below, above, num_evaluations = find_groundwater_threshold(eval_E_max, 10, 1e-10)
+    assert threshold == pytest.approx(v_threshold, rel=0.03)
+    assert below <= threshold <= above
+
+
+def test_threshold_is_found_from_a_velocity_that_already_departs():
+    # The prescreen velocity departs by 20 %, so the search has to step down first.
+    threshold, below, above, num_evaluations = find_groundwater_threshold(eval_E_max, 10, 5e-8)
+    assert threshold == pytest.approx(v_threshold, rel=0.03)
+    assert below <= threshold <= above
+
+
+def test_departure_at_every_velocity_raises():
+    with pytest.raises(ValueError, match="v_min"):
+        find_groundwater_threshold(lambda velocity: 5.0, 10, 1e-8)